@@ -0,0 +1,210 @@
+import os, json, shutil, hashlib, errno, uuid, copy
+from collections import OrderedDict
+from threading import Lock
+
+from witica.util import makedirs, get_cache_folder, suni, open_database
+from witica.log import *
+
+
+class ConversionCache(Loggable):
+	"""Size bounded store for the results of file conversions, addressed by a hash of everything a conversion depends on
+
+	An entry is a directory containing the converted files and an entry.json with their names and additional info.
+	The least recently used entries are removed when the cache grows bigger than max_size bytes."""
+
+	def __init__(self, folder, max_size):
+		self.log_id = "ConversionCache"
+		self.folder = folder
+		self.max_size = max_size
+		self._lock = Lock()
+		self._size = None #total size of all entries, computed on first store
+
+	@staticmethod
+	def make_key(*parts):
+		"""returns a key for the given json serializable parts"""
+		return hashlib.sha256(json.dumps(parts, sort_keys=True)).hexdigest()
+
+	def get_entry_dir(self, key):
+		return os.path.join(self.folder, key)
+
+	def restore(self, key, destinations, check = None):
+		"""copies the files of an entry to destinations (name -> path), returns False if there is no such entry
+		check is called with the info of the entry and can reject the entry by returning False"""
+		entry_dir = self.get_entry_dir(key)
+		with self._lock: #the files are copied without holding the lock, an entry evicted meanwhile is a miss
+			try:
+				entry = json.loads(open(os.path.join(entry_dir, "entry.json")).read())
+				os.utime(entry_dir, None) #mark as recently used
+			except Exception, e:
+				return False
+		if not set(destinations.keys()) <= set(entry["files"]):
+			return False
+		if check and not check(entry["info"]):
+			return False
+		try:
+			for name, path in destinations.iteritems():
+				makedirs(os.path.dirname(path))
+				shutil.copyfile(os.path.join(entry_dir, name), path)
+		except Exception, e:
+			if os.path.isdir(entry_dir):
+				self.log_exception("Restoring entry '" + key + "' failed.", Logtype.WARNING)
+			return False
+		return True
+
+	def store(self, key, files, info = None):
+		"""adds an entry with the given files (name -> path), replaces an existing entry with the same key"""
+		entry_dir = self.get_entry_dir(key)
+		tmp_dir = os.path.join(self.folder, "tmp-" + uuid.uuid4().hex)
+		try:
+			makedirs(tmp_dir)
+			for name, path in files.iteritems():
+				shutil.copyfile(path, os.path.join(tmp_dir, name))
+			f = open(os.path.join(tmp_dir, "entry.json"), "w")
+			f.write(json.dumps({"files": files.keys(), "info": info}))
+			f.close()
+			size = self.get_dir_size(tmp_dir)
+
+			with self._lock:
+				if self._size == None:
+					self._size = sum([self.get_dir_size(d) for d, mtime in self.get_entries()])
+				if os.path.isdir(entry_dir):
+					self._size -= self.get_dir_size(entry_dir)
+					shutil.rmtree(entry_dir)
+				os.rename(tmp_dir, entry_dir)
+				self._size += size
+				if self._size > self.max_size:
+					self.evict()
+		except Exception, e:
+			self.log_exception("Storing entry '" + key + "' failed.", Logtype.WARNING)
+			shutil.rmtree(tmp_dir, ignore_errors = True)
+
+	def evict(self):
+		"""removes least recently used entries until the cache uses at most 90% of max_size, must be called while holding the lock"""
+		entries = sorted(self.get_entries(), key = lambda entry: entry[1])
+		for entry_dir, mtime in entries:
+			if self._size <= 0.9*self.max_size:
+				break
+			size = self.get_dir_size(entry_dir)
+			shutil.rmtree(entry_dir, ignore_errors = True)
+			self._size -= size
+
+	def get_entries(self):
+		"""returns the directories and last usage times of all entries"""
+		entries = []
+		if os.path.isdir(self.folder):
+			for name in os.listdir(self.folder):
+				entry_dir = os.path.join(self.folder, name)
+				if not name.startswith("tmp-") and os.path.isdir(entry_dir):
+					entries.append((entry_dir, os.path.getmtime(entry_dir)))
+		return entries
+
+	def get_dir_size(self, directory):
+		size = 0
+		for name in os.listdir(directory):
+			try:
+				size += os.path.getsize(os.path.join(directory, name))
+			except OSError, e:
+				if not(e.errno == errno.ENOENT):
+					raise
+		return size
+
+	def clear(self):
+		with self._lock:
+			shutil.rmtree(self.folder, ignore_errors = True)
+			self._size = 0
+
+MAX_SIZE = 1024*1024*1024 #bytes used by the conversion cache at most
+
+conversion_cache = None
+conversion_cache_lock = Lock()
+
+def get_conversion_cache():
+	"""returns the conversion cache shared by all targets"""
+	global conversion_cache
+	with conversion_cache_lock:
+		if conversion_cache == None:
+			conversion_cache = ConversionCache(get_cache_folder("Conversion"), MAX_SIZE)
+		return conversion_cache
+
+class MetadataCache(Loggable):
+	"""Metadata extracted from files, addressed by the absolute path, size and mtime of the file and the extractor version
+
+	The most recently used entries are kept in memory, if a database filename is given all entries are also stored there,
+	so that unchanged files don't have to be parsed again after a restart."""
+
+	def __init__(self, size, filename = None):
+		self.log_id = "MetadataCache"
+		self.size = size
+		self._lock = Lock()
+		self._entries = OrderedDict() #key -> metadata, least recently used first
+		self._db = None
+		if filename:
+			self.open(filename)
+
+	def open(self, filename):
+		"""adds the persistent tier stored in the database filename"""
+		with self._lock:
+			try:
+				makedirs(os.path.dirname(filename))
+				self._db = open_database(filename)
+				self._db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, version TEXT, metadata TEXT)")
+				self._db.commit()
+			except Exception, e:
+				self.log_exception("Opening metadata cache '" + filename + "' failed.", Logtype.WARNING)
+				self._db = None
+
+	@staticmethod
+	def make_key(filename, version):
+		"""returns the key for the current state of the file, version identifies the extractor"""
+		st = os.stat(filename)
+		return (suni(os.path.abspath(filename)), st.st_size, st.st_mtime, version)
+
+	def get(self, key):
+		"""returns a copy of the cached metadata or None"""
+		with self._lock:
+			if key in self._entries:
+				metadata = self._entries.pop(key)
+				self._entries[key] = metadata
+				return copy.deepcopy(metadata)
+			if self._db == None:
+				return None
+			path, size, mtime, version = key
+			row = self._db.execute("SELECT metadata FROM files WHERE path = ? AND size = ? AND mtime = ? AND version = ?", (path, size, mtime, version)).fetchone()
+			if row == None:
+				return None
+			metadata = json.loads(row[0])
+			self._add(key, metadata)
+			return copy.deepcopy(metadata)
+
+	def put(self, key, metadata):
+		"""caches a copy of metadata, replaces the metadata cached for older states of the file"""
+		metadata = copy.deepcopy(metadata)
+		with self._lock:
+			self._add(key, metadata)
+			if self._db == None:
+				return
+			try:
+				metadatastr = json.dumps(metadata)
+			except Exception, e: #metadata can't be persisted, keep it only in memory
+				self._db.execute("DELETE FROM files WHERE path = ?", (key[0],))
+			else:
+				self._db.execute("INSERT OR REPLACE INTO files (path, size, mtime, version, metadata) VALUES (?, ?, ?, ?, ?)", key + (metadatastr,))
+			self._db.commit()
+
+	def _add(self, key, metadata):
+		"""adds an entry to the memory tier, must be called while holding the lock"""
+		self._entries.pop(key, None)
+		self._entries[key] = metadata
+		while len(self._entries) > self.size:
+			self._entries.popitem(last = False)
+
+	def clear(self):
+		with self._lock:
+			self._entries = OrderedDict()
+			if self._db != None:
+				self._db.execute("DELETE FROM files")
+				self._db.commit()
+
+METADATA_CACHE_SIZE = 4096 #number of files whose metadata is kept in memory
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE)
@@ -1,16 +1,12 @@
 from abc import ABCMeta
 import codecs, json
 
-import markdown
-from markdown.treeprocessors import Treeprocessor
-from markdown.inlinepatterns import LinkPattern, ImagePattern
-from markdown.extensions import Extension
-
 from witica.util import sstr, suni, throw
 from witica import *
 from witica.log import *
 from witica.source import Source, SourceItem
 from witica.metadata import extractor
+from witica.metadata.document import get_document
 
 class IntegrityChecker(Loggable):
 	"""Provides methods to check the integrity of an item"""
@@ -86,93 +82,39 @@ class IntegrityChecker(Loggable):
 
 	def check_md(self, item, srcfile):
 		faults = []
-		
-		input_file = codecs.open(item.source.get_absolute_path(srcfile), mode="r", encoding="utf-8")
-		text = input_file.read()
-
-		link_check_ext = LinkCheckExtension(item, srcfile, faults)
-		inline_item_check_ext = InlineItemCheckExtension(item, srcfile, faults)
 
 		try:
-			#split json and markdown parts
-			jsonstr, mdstring = re.match(extractor.RE_MD_SPLIT_JSON_MD,text).groups()
-			#split title and body part
-			title, mdbody = re.match(extractor.RE_MD_SPLIT_TITLE_BODY,mdstring).groups()
-			markdown.markdown(mdbody, extensions = [link_check_ext, inline_item_check_ext])
+			references = get_document(item.source.get_absolute_path(srcfile)).get_references()
 		except Exception, e:
 			faults.append(SyntaxFault(e.message, item))
+			return faults
 
-		return faults
-
-
-#markdown extensions
-class ItemPattern(LinkPattern):
-	""" Return a view element from the given match. """
-	def __init__(self, pattern, md, item, srcfile, faults):
-		LinkPattern.__init__(self, pattern, md)
-		self.item = item
-		self.srcfile = srcfile
-		self.faults = faults
-
-	def handleMatch(self, m):		
-		item_id = m.group(3)
-		if re.match(extractor.RE_ITEM_REFERENCE, item_id):
-			item_id = self.item.source.resolve_reference(item_id,self.item)
-		#check target exists
-		if not(self.item.source.item_exists(item_id)):
-			self.faults.append(TargetNotFoundFault("Embedded item '" + item_id + "' in file '" + self.srcfile + "' was not found in the source '" + self.item.source.source_id + "'.", self.item))
-		#check if self-reference
-		if item_id == self.item.item_id:
-			self.faults.append(CirularReferenceFault("Embedded item '" + item_id + "' in file '" + self.srcfile + "' is self-referencing.", self.item))
-		#check render json parameters
-		if not m.group(2) == None:
-			renderjson = m.group(2)
-			try:
-				json.loads(renderjson)
-			except Exception, e:
-				self.faults.append(SyntaxFault("The syntax of the render parameters of embedded item '" + item_id + "' in file '" + self.srcfile + "' is invalid. " + e.message, self.item))
-		return None
-
-class InlineItemCheckExtension(Extension):
-	""" add inline views to markdown """
-	def __init__(self, item, srcfile, faults):
-		self.item = item
-		self.srcfile = srcfile
-		self.faults = faults
-
-	def extendMarkdown(self, md, md_globals):
-		""" Override existing Processors. """
-		md.inlinePatterns['image_link'] = ImagePattern(extractor.RE_MD_IMAGE_LINK, md)
-		md.inlinePatterns.add('item_link', ItemPattern(extractor.RE_MD_ITEM_LINK, md, self.item, self.srcfile, self.faults),'>image_link')
-
-class LinkCheckExtension(Extension):
-	def __init__(self, item, srcfile, faults):
-		self.item = item
-		self.srcfile = srcfile
-		self.faults = faults
-
-	def extendMarkdown(self, md, md_globals):
-		# Insert instance of 'mypattern' before 'references' pattern
-		md.treeprocessors.add("link", LinkTreeprocessor(self.item, self.srcfile, self.faults), "_end")
-
-class LinkTreeprocessor(Treeprocessor):
-	def __init__(self, item, srcfile, faults):
-		self.item = item
-		self.srcfile = srcfile
-		self.faults = faults
-
-	def run(self, root):
-		for a in root.findall(".//a"):
-			item_id = a.get("href")
+		for kind, reference, renderparams in references:
+			item_id = reference
 			if re.match(extractor.RE_ITEM_REFERENCE, item_id):
-				item_id = self.item.source.resolve_reference(item_id,self.item)
+				item_id = item.source.resolve_reference(item_id,item)
+			if kind == "view":
+				#check target exists
+				if not(item.source.item_exists(item_id)):
+					faults.append(TargetNotFoundFault("Embedded item '" + item_id + "' in file '" + srcfile + "' was not found in the source '" + item.source.source_id + "'.", item))
+				#check if self-reference
+				if item_id == item.item_id:
+					faults.append(CirularReferenceFault("Embedded item '" + item_id + "' in file '" + srcfile + "' is self-referencing.", item))
+				#check render json parameters
+				if not renderparams == None:
+					try:
+						json.loads(renderparams)
+					except Exception, e:
+						faults.append(SyntaxFault("The syntax of the render parameters of embedded item '" + item_id + "' in file '" + srcfile + "' is invalid. " + e.message, item))
+			else:
 				#check if exists
-				if not(self.item.source.item_exists(item_id)):
-					self.faults.append(TargetNotFoundFault("Link target '" + item_id + "' in file '" + self.srcfile + "' was not found in the source '" + self.item.source.source_id + "'.", self.item))
+				if not(item.source.item_exists(item_id)):
+					faults.append(TargetNotFoundFault("Link target '" + item_id + "' in file '" + srcfile + "' was not found in the source '" + item.source.source_id + "'.", item))
 				#check if self-reference
-				if item_id == self.item.item_id:
-					self.faults.append(CirularReferenceFault("Link target '" + item_id + "' in file '" + self.srcfile + "' is self-referencing.", self.item))
-		return root
+				if item_id == item.item_id:
+					faults.append(CirularReferenceFault("Link target '" + item_id + "' in file '" + srcfile + "' is self-referencing.", item))
+
+		return faults
 
 
 #fault classes
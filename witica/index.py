@@ -0,0 +1,254 @@
+import os, re, sqlite3, unicodedata, bisect
+from threading import RLock
+
+from witica.util import suni, dropbox_content_hash
+from witica.metadata import extractor
+
+
+def normalize_path(path):
+	"""converts a local path or item id to a NFC normalized unicode string with / as separator"""
+	path = unicodedata.normalize("NFC", suni(path))
+	if os.sep != "/":
+		path = path.replace(os.sep, "/")
+	return path
+
+class ItemIndex(object):
+	"""Maintains a mapping from item ids to the files (and their modification times) of the items in a source"""
+
+	VERSION = 3 #version of the database schema
+
+	def __init__(self, source):
+		self.source = source
+		self._lock = RLock()
+		self._items = None #item_id -> {filename: mtime}, None until the index was built
+		self._files = None #filename -> (mtime, size, content hash) for all files in the source
+		self._item_ids = None #sorted ids of the existing items, None if the items changed
+		self.generation = 0 #incremented whenever files were added, changed or removed
+		self._item_ids_registry = None #version of the extractor registry the item ids were computed for
+		self._db = None
+		self._cursor = None
+
+	def open(self, filename, cursor):
+		"""persists the index in the database file filename, the index is reused if it was written for the given source cursor"""
+		with self._lock:
+			self._db = sqlite3.connect(filename, check_same_thread = False)
+			self._db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+			if self._get_db_state("version") != unicode(self.VERSION): #drop index written by other version
+				self._db.execute("DROP TABLE IF EXISTS files")
+				self._db.execute("DROP TABLE IF EXISTS metadata") #written by version 2
+				self._db.execute("DELETE FROM state")
+			self._db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, item_id TEXT, mtime REAL, size INTEGER, hash TEXT)")
+			self._db.execute("CREATE INDEX IF NOT EXISTS files_item_id ON files (item_id)")
+			self._db.commit()
+			self._cursor = cursor
+			self._items = None
+			self._files = None
+
+	def _get_db_state(self, key):
+		row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+		return row[0] if row else None
+
+	def _set_db_state(self, key, value):
+		self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+	def _load(self):
+		"""builds the index if necessary, must be called while holding the lock"""
+		if self._items == None:
+			self._item_ids = None
+			self.generation += 1
+			self._items = {}
+			self._files = {}
+			if self._db and self._cursor \
+					and self._get_db_state("version") == unicode(self.VERSION) \
+					and self._get_db_state("cursor") == self._cursor:
+				for path, item_id, mtime, size, content_hash in self._db.execute("SELECT path, item_id, mtime, size, hash FROM files"):
+					self._files[path] = (mtime, size, content_hash)
+					if item_id != None:
+						self._items.setdefault(item_id, {})[path] = mtime
+			else:
+				self._clear_db()
+				self._build()
+
+	def _build(self):
+		root = self.source.get_absolute_path("")
+		if isinstance(root, unicode):
+			root = root.encode("utf-8")
+		for dirpath, dirs, files in os.walk(root, topdown=True):
+			for filename in files:
+				abspath = os.path.join(dirpath, filename)
+				try:
+					self._add(abspath[len(root)+1:], os.stat(abspath))
+				except OSError:
+					pass #file was removed in the meantime
+
+	def _clear_db(self):
+		if self._db:
+			self._db.execute("DELETE FROM files")
+			self._db.execute("DELETE FROM state")
+
+	def _add(self, local_path, st, content_hash = None):
+		local_path = normalize_path(local_path)
+		self._files[local_path] = (st.st_mtime, st.st_size, content_hash)
+		item_id = None
+		match = re.match(extractor.RE_ITEM_SPLIT_ITEMID_EXTENSION, local_path)
+		if match:
+			item_id = match.group(1)
+			self._items.setdefault(item_id, {})[local_path] = st.st_mtime
+			self._item_ids = None
+			self.generation += 1
+		if self._db:
+			self._db.execute("INSERT OR REPLACE INTO files (path, item_id, mtime, size, hash) VALUES (?, ?, ?, ?, ?)", (local_path, item_id, st.st_mtime, st.st_size, content_hash))
+
+	def _remove(self, local_path):
+		local_path = normalize_path(local_path)
+		self._files.pop(local_path, None)
+		match = re.match(extractor.RE_ITEM_SPLIT_ITEMID_EXTENSION, local_path)
+		if match and match.group(1) in self._items:
+			item_id = match.group(1)
+			files = self._items[item_id]
+			files.pop(local_path, None)
+			if len(files) == 0:
+				del self._items[item_id]
+			self._item_ids = None
+			self.generation += 1
+		if self._db:
+			self._db.execute("DELETE FROM files WHERE path = ?", (local_path,))
+
+	def _remove_dir(self, local_path):
+		prefix = normalize_path(local_path).rstrip("/") + "/"
+		for path in [path for path in self._files if path.startswith(prefix)]:
+			del self._files[path]
+		for item_id in [item_id for item_id in self._items if item_id.startswith(prefix)]:
+			del self._items[item_id]
+			self._item_ids = None
+			self.generation += 1
+		if self._db:
+			self._db.execute("DELETE FROM files WHERE path >= ? AND path < ?", (prefix, prefix + u"\uffff"))
+
+	def commit(self, cursor):
+		"""marks the index as being in sync with the given source cursor and writes it to disk"""
+		with self._lock:
+			self._cursor = cursor
+			if self._db and self._items != None: #otherwise nothing was changed since the index was opened
+				self._set_db_state("version", unicode(self.VERSION))
+				self._set_db_state("cursor", cursor)
+				self._db.commit()
+
+	def flush(self):
+		"""writes pending changes to disk without changing the source cursor the index is in sync with"""
+		with self._lock:
+			if self._db:
+				self._db.commit()
+
+	def clear(self):
+		"""empties the index, i.e. after the source cache was deleted"""
+		with self._lock:
+			self._items = {}
+			self._files = {}
+			self._item_ids = None
+			self.generation += 1
+			self._clear_db()
+
+	def invalidate(self):
+		"""forces the index to be rebuilt from the file system on next access"""
+		with self._lock:
+			self._items = None
+			self._files = None
+			self._cursor = None
+
+	def add_file(self, local_path, content_hash = None):
+		"""adds or updates a file that was created or changed in the source, optionally with its known content hash"""
+		with self._lock:
+			self._load()
+			self._add(local_path, os.stat(self.source.get_absolute_path(local_path)), content_hash)
+
+	def get_content_hash(self, local_path):
+		"""returns the Dropbox content hash of a file, the hash is only computed if the file changed since it was last recorded"""
+		with self._lock:
+			self._load()
+			local_path = normalize_path(local_path)
+			st = os.stat(self.source.get_absolute_path(local_path))
+			if local_path in self._files:
+				mtime, size, content_hash = self._files[local_path]
+				if content_hash and mtime == st.st_mtime and size == st.st_size:
+					return content_hash
+
+		content_hash = dropbox_content_hash(self.source.get_absolute_path(local_path))
+		with self._lock:
+			if self._files.get(local_path, (None, None, None))[:2] == (st.st_mtime, st.st_size):
+				self._files[local_path] = (st.st_mtime, st.st_size, content_hash)
+				if self._db:
+					self._db.execute("UPDATE files SET hash = ? WHERE path = ?", (content_hash, local_path))
+		return content_hash
+
+	def get_paths(self):
+		"""returns all files in the source (including files not belonging to any item)"""
+		with self._lock:
+			self._load()
+			return self._files.keys()
+
+	def get_file_stat(self, local_path):
+		"""returns the recorded (mtime, size) of a file or None if the file is not in the index"""
+		with self._lock:
+			self._load()
+			entry = self._files.get(normalize_path(local_path))
+			return entry[:2] if entry else None
+
+	def remove_path(self, local_path):
+		"""removes a file or a directory (including all files inside) that was deleted from the source"""
+		with self._lock:
+			self._load()
+			self._remove(local_path)
+			self._remove_dir(local_path)
+
+	def get_item_ids(self, prefix = u""):
+		"""returns a sorted list of the ids of all existing items, optionally only the ones starting with prefix"""
+		with self._lock:
+			self._load()
+			if self._item_ids == None or self._item_ids_registry != extractor.registry_version: #item files depend on the extractors
+				self._item_ids = sorted([item_id for item_id in self._items if self._get_itemfile(item_id) != None])
+				self._item_ids_registry = extractor.registry_version
+			if prefix == u"":
+				return list(self._item_ids)
+			prefix = normalize_path(prefix)
+			start = bisect.bisect_left(self._item_ids, prefix)
+			end = bisect.bisect_left(self._item_ids, prefix + u"\uffff")
+			return self._item_ids[start:end]
+
+	def get_files(self, item_id):
+		with self._lock:
+			self._load()
+			return sorted(self._items.get(normalize_path(item_id), {}).keys())
+
+	def _get_file(self, item_id, content):
+		"""returns the item file or the main content file of an item, the file of the preferred registered file type"""
+		preferred, preferred_type = None, None
+		for filename in self._items.get(item_id, {}):
+			filetype = extractor.get_filetype(filename[len(item_id)+1:])
+			if filetype and (filetype.content if content else filetype.extractor) and filetype.precedes(preferred_type):
+				preferred, preferred_type = filename, filetype
+		return preferred
+
+	def _get_itemfile(self, item_id):
+		return self._get_file(item_id, False) #None if the item does not exist
+
+	def get_itemfile(self, item_id):
+		with self._lock:
+			self._load()
+			return self._get_itemfile(normalize_path(item_id))
+
+	def get_contentfile(self, item_id):
+		with self._lock:
+			self._load()
+			return self._get_file(normalize_path(item_id), True)
+
+	def get_mtime(self, item_id):
+		with self._lock:
+			self._load()
+			return max(self._items.get(normalize_path(item_id), {}).values())
+
+	def exists(self, item_id):
+		return self.get_itemfile(item_id) != None
+
+	def __len__(self):
+		return len(self.get_item_ids())
@@ -0,0 +1,117 @@
+import os, ctypes, ctypes.util, struct, select, errno, platform
+
+#constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+EVENT_HEADER = struct.Struct("iIII") #wd, mask, cookie, len
+
+_libc = None
+
+def _get_libc():
+	global _libc
+	if _libc == None:
+		_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+	return _libc
+
+def is_supported():
+	"""checks if the inotify API is available on this system"""
+	if platform.system() != "Linux":
+		return False
+	try:
+		return hasattr(_get_libc(), "inotify_init1")
+	except OSError:
+		return False
+
+class TreeWatcher(object):
+	"""Watches a directory tree recursively for changed files using the inotify API of the Linux kernel"""
+
+	MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+	def __init__(self, root):
+		self.root = root.encode("utf-8") if isinstance(root, unicode) else root
+		self.watches = {} #watch descriptor -> local path of the watched directory
+		self.changed_paths = set() #local paths of files or directories that changed
+		self.overflowed = False #if True, events were lost and the whole tree needs to be checked
+
+		self.fd = _get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, "inotify_init1 failed: " + os.strerror(e))
+		self.add_watches("")
+
+	def add_watches(self, local_path):
+		"""watches the directory local_path and all its subdirectories"""
+		for dirpath, dirs, files in os.walk(os.path.join(self.root, local_path)):
+			dirs[:] = [d for d in dirs if not d.startswith(".")]
+			wd = _get_libc().inotify_add_watch(self.fd, dirpath, self.MASK)
+			if wd < 0:
+				e = ctypes.get_errno()
+				if e in [errno.ENOENT, errno.ENOTDIR]: #directory removed in the meantime
+					continue
+				raise OSError(e, "Watching '" + dirpath + "' failed: " + os.strerror(e))
+			self.watches[wd] = dirpath[len(self.root)+1:]
+
+	def wait(self, timeout):
+		"""waits at most timeout seconds for new events, returns True if events were read"""
+		try:
+			readable = select.select([self.fd], [], [], timeout)[0]
+		except select.error as e:
+			if e.args[0] == errno.EINTR:
+				return False
+			raise
+		if readable:
+			self.read()
+			return True
+		return False
+
+	def read(self):
+		"""reads all pending events and records the changed paths"""
+		while True:
+			try:
+				buf = os.read(self.fd, 64*1024)
+			except OSError as e:
+				if e.errno in [errno.EAGAIN, errno.EINTR]:
+					return
+				raise
+			pos = 0
+			while pos + EVENT_HEADER.size <= len(buf):
+				wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+				name = buf[pos + EVENT_HEADER.size:pos + EVENT_HEADER.size + length].rstrip("\0")
+				pos += EVENT_HEADER.size + length
+				self.handle_event(wd, mask, name)
+
+	def handle_event(self, wd, mask, name):
+		if mask & IN_Q_OVERFLOW:
+			self.overflowed = True
+		elif mask & IN_IGNORED:
+			self.watches.pop(wd, None)
+		elif wd in self.watches and not name.startswith("."):
+			path = os.path.join(self.watches[wd], name) if self.watches[wd] else name
+			self.changed_paths.add(path)
+			if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+				self.add_watches(path)
+
+	def pop_changes(self):
+		"""returns and resets the changed paths and the overflow flag"""
+		changed_paths, overflowed = self.changed_paths, self.overflowed
+		self.changed_paths, self.overflowed = set(), False
+		return changed_paths, overflowed
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
@@ -31,6 +31,8 @@ class CColors(object):
 
 class Loggable(object):
 	"""Inherit and set log_id to have a log function in any class"""
+	__slots__ = () #allows subclasses to use __slots__
+
 	def __init__(self):
 		self.log_id = "anonymous"
 
@@ -15,7 +15,7 @@ from witica.source import Source, MetaChanged, ItemChanged, ItemRemoved
 from witica.targets import target, web, statichtml
 from witica.check import IntegrityChecker
 from witica.util import sstr, suni, throw
-from witica import util
+from witica import util, cache
 
 VERSION = pkg_resources.get_distribution("witica").version
 
@@ -30,20 +30,24 @@ def shutdown():
 		log_exception("Shutdown failed.", Logtype.ERROR)
 	finally:
 		seconds_left = 30
-		while seconds_left > 0 and threading.active_count() > 2: #main + logging thread
+		while seconds_left > 0 and len(get_working_threads()) > 0:
 			time.sleep(1)
 			seconds_left -= 1
-		if threading.active_count() > 2: #main + logging thread
+		web.stop_image_pool()
+		if len(get_working_threads()) > 0:
 			print("Hanging threads:")
-			for t in threading.enumerate():
-				if not(t == threading.current_thread()) and t.isAlive():
-					print("* " + t.name)
+			for t in get_working_threads():
+				print("* " + t.name)
 			print("Force quit.")
 			Logger.stop()
 			sys.exit(0) #TODO: does this really kill all threads?
 		Logger.stop()
 		pkg_resources.cleanup_resources(force=False)
 
+def get_working_threads():
+	"""returns all running threads except the main and logging thread and daemon threads, that don't prevent exiting"""
+	return [t for t in threading.enumerate() if t.isAlive() and not(t.daemon or t == threading.current_thread() or t == Logger.get_thread())]
+
 def signal_handler(signal, frame):
 	log("Shutdown requested by user.", Logtype.INFO)
 	shutdown()
@@ -167,6 +171,12 @@ def rebuild_command(args):
 		shutdown()
 		return
 
+	if args.force:
+		for target in currentsite.targets:
+			for p in target.publishing:
+				p.manifest.clear()
+		cache.metadata_cache.clear()
+
 	if len(args.item) == 0:
 		rebuild_meta(currentsite.source)
 		log("Site metadata enqued for rebuilding.", Logtype.INFO)
@@ -175,8 +185,7 @@ def rebuild_command(args):
 
 	for item in items:
 		try:
-			for path in item.files:
-				currentsite.source.changeEvent(currentsite.source, ItemChanged(currentsite.source, item.item_id, path))	
+			currentsite.source.changeEvent(currentsite.source, ItemChanged(currentsite.source, item.item_id, item.files))
 		except Exception, e:
 			log_exception("Item '" + item.item_id + "'' could not be enqued for rebuilding.", Logtype.ERROR)	
 	log(str(len(items)) + " item" + ("s" if len(items) != 1 else "") + " enqued for rebuilding.", Logtype.INFO)
@@ -247,7 +256,7 @@ def get_matching_items(source, args):
 	if len(args.item) > 0:
 		#return matching items
 		for idpattern in args.item:
-			items.extend(currentsite.source.items.get_items(source.prefix + idpattern.lower()))
+			items.extend(currentsite.source.items.get_items(source.prefix + (idpattern.lower() if source.lower_case_ids else idpattern)))
 	elif len(args.item) == 0:
 		items = [item for item in source.items if item.item_id.startswith(source.prefix)]
 	return items
@@ -261,6 +270,8 @@ def main():
 	sys.stdout = UTF8Writer(sys.stdout)
 
 	extractor.register_default_extractors()
+	cache.metadata_cache.open(os.path.join(util.get_cache_folder("Metadata"), "metadata.db"))
+	web.start_image_pool() #fork the pool processes before any other thread is started
 
 	target.register("WebTarget", web.WebTarget)
 	target.register("StaticHtmlTarget", statichtml.StaticHtmlTarget)
@@ -295,6 +306,7 @@ def main():
 	parser_rebuild.add_argument('-V', '--verbose', action='store_true', help="show also info messages and debbuging info")
 	parser_rebuild.add_argument('-s', '--source', help="the source configuration file to use")
 	parser_rebuild.add_argument('-t', '--targets', nargs='+', help="list of ids of targets that should be used for the conversion, default: all")
+	parser_rebuild.add_argument('-f', '--force', action='store_true', help="extract metadata and publish all rebuilt files again, also if they didn't change")
 	parser_rebuild.add_argument('item', nargs='*', help="list of ids of items or indicies that should be updated")
 	parser_rebuild.set_defaults(func=rebuild_command)
 
@@ -320,15 +332,10 @@ def main():
 	while threading.active_count() > 1:
 		try:
 			# Join all threads to receive sigint
-			[t.join(1) for t in threading.enumerate() if t.isAlive() and not(t == threading.current_thread() or t == Logger.get_thread())]
+			[t.join(1) for t in get_working_threads()]
 			
 			#if only the main and logging threads are running stop program
-			working = False
-			for t in threading.enumerate():
-				if t.isAlive() and not(t == threading.current_thread() or t == Logger.get_thread()):
-					working = True
-
-			if not working:
+			if len(get_working_threads()) == 0:
 				shutdown()
 				break
 
@@ -0,0 +1,160 @@
+import os, re, json, codecs, copy
+from collections import OrderedDict
+from threading import Lock, local
+
+import markdown
+from markdown.treeprocessors import Treeprocessor
+from markdown.inlinepatterns import LinkPattern, ImagePattern
+from markdown.extensions import Extension
+
+from witica.util import sstr
+from witica.metadata.extractor import RE_MD_SPLIT_JSON_MD, RE_MD_SPLIT_TITLE_BODY, RE_MD_IMAGE_LINK, RE_MD_ITEM_LINK, RE_ITEM_REFERENCE
+
+
+CACHE_SIZE = 128 #number of parsed documents kept in memory
+
+documents = OrderedDict() #(filename, mtime, size) -> MDDocument, least recently used first
+documents_lock = Lock()
+
+def get_document(filename):
+	"""returns the parsed markdown file, the file is only read and parsed again if it changed"""
+	st = os.stat(filename)
+	key = (filename, st.st_mtime, st.st_size)
+	with documents_lock:
+		document = documents.pop(key, None)
+		if document:
+			documents[key] = document
+			return document
+
+	document = MDDocument(filename)
+	with documents_lock:
+		documents[key] = document
+		while len(documents) > CACHE_SIZE:
+			documents.popitem(last = False)
+	return document
+
+def escape_attribute(text):
+	"""escapes an attribute value the same way markdown does"""
+	return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\"", "&quot;").replace("\n", "&#10;")
+
+RE_REFERENCE_PLACEHOLDER = "\x02witica-ref:(\d+)\x03"
+
+class MDDocument(object):
+	"""Markdown file split into json metadata, title and body, the body is rendered only once for all targets
+	In the rendered html the references to items are placeholders that are replaced when the html is requested."""
+
+	def __init__(self, filename):
+		self.filename = filename
+		f = codecs.open(filename, mode="r", encoding="utf-8")
+		try:
+			text = f.read()
+		finally:
+			f.close()
+
+		match = re.match(RE_MD_SPLIT_JSON_MD, text)
+		if not match:
+			raise IOError("Could not split JSON and markdown parts of file '" + sstr(filename) + "'.")
+		self.jsonstr, mdstr = match.groups()
+		self.title, self.body = re.match(RE_MD_SPLIT_TITLE_BODY, mdstr).groups()
+
+		self._lock = Lock()
+		self._json = None
+		self._html = None
+		self._references = None
+
+	def get_json(self):
+		"""returns the explicit json metadata"""
+		with self._lock:
+			if self._json == None:
+				self._json = json.loads(self.jsonstr) if self.jsonstr != None else {}
+			return copy.deepcopy(self._json)
+
+	def get_metadata(self):
+		"""returns the metadata given by the title and the json part"""
+		meta = {}
+		if self.title != None:
+			meta["title"] = self.title
+		meta.update(self.get_json())
+		return meta
+
+	def render(self):
+		with self._lock:
+			if self._html == None:
+				renderer = get_renderer()
+				self._html = renderer.convert(self.body)
+				self._references = renderer.references
+			return self._html, self._references
+
+	def get_references(self):
+		"""returns the references to items in the body as list of (kind, reference, render parameters)
+		kind is "view" for embedded items or "link" for links, only views have render parameters"""
+		return self.render()[1]
+
+	def get_html(self, resolve):
+		"""returns the body as html, resolve(kind, reference) is called to get the value for each reference"""
+		html, references = self.render()
+		return re.sub(RE_REFERENCE_PLACEHOLDER, lambda m: escape_attribute(resolve(*references[int(m.group(1))][:2])), html)
+
+#markdown extensions
+renderers = local()
+
+def get_renderer():
+	"""returns the markdown renderer of the current thread"""
+	if not hasattr(renderers, "renderer"):
+		renderers.renderer = MarkdownRenderer()
+	return renderers.renderer
+
+class MarkdownRenderer(object):
+	"""Markdown converter with the witica extensions, that is created once per thread and reused for all documents"""
+
+	def __init__(self):
+		self.references = []
+		self.md = markdown.Markdown(extensions = [ReferenceExtension(self)])
+
+	def convert(self, text):
+		self.references = []
+		return self.md.reset().convert(text)
+
+	def add_reference(self, kind, reference, renderparams = None):
+		"""records a reference and returns the placeholder for it"""
+		self.references.append((kind, reference, renderparams))
+		return "\x02witica-ref:" + str(len(self.references)-1) + "\x03"
+
+class ItemPattern(LinkPattern):
+	""" Return a view element from the given match. """
+	def __init__(self, pattern, md, renderer):
+		LinkPattern.__init__(self, pattern, md)
+		self.renderer = renderer
+
+	def handleMatch(self, m):
+		el = markdown.util.etree.Element("view")
+		item_id = m.group(3)
+		placeholder = self.renderer.add_reference("view", item_id, m.group(2))
+		if re.match(RE_ITEM_REFERENCE, item_id):
+			item_id = placeholder
+		el.set('item', item_id)
+		if not m.group(2) == None:
+			renderparam = markdown.util.etree.Comment(m.group(2))
+			el.append(renderparam)
+		return el
+
+class LinkTreeprocessor(Treeprocessor):
+	def __init__(self, renderer):
+		self.renderer = renderer
+
+	def run(self, root):
+		for a in root.findall(".//a"):
+			item_id = a.get("href")
+			if re.match(RE_ITEM_REFERENCE, item_id):
+				a.set("href", self.renderer.add_reference("link", item_id))
+		return root
+
+class ReferenceExtension(Extension):
+	""" add inline views to markdown and mark references to items """
+	def __init__(self, renderer):
+		self.renderer = renderer
+
+	def extendMarkdown(self, md, md_globals):
+		md.inlinePatterns['image_link'] = ImagePattern(RE_MD_IMAGE_LINK, md)
+		md.inlinePatterns.add('item_link', ItemPattern(RE_MD_ITEM_LINK, md, self.renderer),'>image_link')
+		md.treeprocessors.add("link", LinkTreeprocessor(self.renderer), "_end")
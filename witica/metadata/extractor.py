@@ -4,6 +4,7 @@ from PIL import Image, ExifTags
 
 
 from witica.util import throw, sstr, suni
+from witica.cache import metadata_cache
 
 #regular expressions regarding item ids
 RE_METAFILE = r'^meta\/[^\n]+$'
@@ -34,37 +35,81 @@ RE_MD_ITEM_LINK = r'!({[\s\S]*?})?\((![\s\S]+?)\)'
 # !{renderparametersjson}(!itemid)
 
 
-registered_extractors = [];
-
-def register(extension, extractor):
-	"""Register new metadata extractor for file extension"""
-	for (ext,extr) in registered_extractors:
-		if extension == ext:
-			raise ValueError("A metadata extractor for extension '" + extension + "' is already registered.")
-	#TODO: check type of extractor
-	registered_extractors.append((extension,extractor))
-	#print("registered: " + extension + " " + sstr(extractor))
+class FileType(object):
+	"""A registered file extension with the extractor used for its files"""
+
+	def __init__(self, extension, extractor, priority, content, order):
+		self.extension = extension
+		self.extractor = extractor #extractor instance or None if no metadata can be extracted
+		self.priority = priority
+		self.content = content
+		self.order = order
+
+	def precedes(self, other):
+		"""returns True if files of this type are preferred to files of the other type"""
+		return other == None or (self.priority, -self.order) > (other.priority, -other.order)
+
+registered_filetypes = {} #extension -> FileType
+registry_version = 0 #incremented whenever the registered file types change
+
+def register(extension, extractor, priority = 0, content = False):
+	"""Register new metadata extractor for file extension
+
+	If an item has several files, the item file is the one with the highest priority that has an extractor.
+	Files with content set to True are content files, the one with the highest priority is the main content file.
+	Among file types with the same priority the one registered first is preferred. extractor can be None for content
+	files that no metadata can be extracted from."""
+	global registry_version
+	if extension in registered_filetypes:
+		raise ValueError("A metadata extractor for extension '" + extension + "' is already registered.")
+	instance = None
+	if extractor != None:
+		for filetype in registered_filetypes.itervalues(): #share one instance per extractor class
+			if type(filetype.extractor) == extractor:
+				instance = filetype.extractor
+				break
+		else:
+			instance = extractor()
+	registered_filetypes[extension] = FileType(extension, instance, priority, content, registry_version)
+	registry_version += 1
+
+def unregister_all():
+	global registry_version
+	registered_filetypes.clear()
+	registry_version += 1
 
 def register_default_extractors():
-	register("item", JSONExtractor)
-	register("json", JSONExtractor)
-	register("md", MDExtractor)
-	register("txt", MDExtractor)
-	register("jpg", ImageExtractor)
-	register("jpeg", ImageExtractor)
+	register("item", JSONExtractor, 60)
+	register("json", JSONExtractor, 50)
+	register("md", MDExtractor, 40, content = True)
+	register("txt", MDExtractor, 30, content = True)
+	register("png", None, 25, content = True)
+	register("jpg", ImageExtractor, 20, content = True)
+	register("jpeg", ImageExtractor, 10)
+
+def get_filetype(extension):
+	"""returns the registered FileType for extension or None"""
+	return registered_filetypes.get(extension)
 
 def is_supported(extension):
-	for (ext,extractor) in registered_extractors:
-		if extension == ext:
-			return True
-	return False
+	filetype = registered_filetypes.get(extension)
+	return filetype != None and filetype.extractor != None
 
 def extract_metadata(filename):
 	extension = filename.rpartition(".")[2]
-	for (ext,extractor) in registered_extractors:
-		if extension == ext:
-			return extractor().extract_metadata(filename)
-	raise ValueError("Could not extract metadata, because a metadata extractor for extension '" + extension + "' is not registered.")
+	filetype = registered_filetypes.get(extension)
+	if filetype == None or filetype.extractor == None:
+		raise ValueError("Could not extract metadata, because a metadata extractor for extension '" + extension + "' is not registered.")
+	extractor = filetype.extractor
+	try:
+		key = metadata_cache.make_key(filename, type(extractor).__name__ + "/" + sstr(extractor.version))
+	except OSError, e: #let the extractor report the error
+		return extractor.extract_metadata(filename)
+	metadata = metadata_cache.get(key)
+	if metadata == None:
+		metadata = extractor.extract_metadata(filename)
+		metadata_cache.put(key, metadata)
+	return metadata
 
 
 class MetadataExtractor(object):
@@ -73,6 +118,7 @@ class MetadataExtractor(object):
 	"""Abstract class representing a metadata extractor"""
 
 	supported_extensions = [];
+	version = 1 #increase when the extracted metadata changes, to invalidate cached metadata
 
 	def __init__(self):
 		pass
@@ -108,29 +154,9 @@ class MDExtractor(MetadataExtractor):
 		pass
 
 	def extract_metadata(self, filename):
+		from witica.metadata.document import get_document #document module depends on this one
 		try:
-			meta = {}
-			
-			#split into json and markdown part
-			f = codecs.open(filename, mode="r", encoding="utf-8")
-			match = re.match(RE_MD_SPLIT_JSON_MD,f.read())
-			f.close()
-
-			if not match:
-				raise IOError("Extracting metadata from file '" + sstr(filename) + "' failed. Could not split JSON and markdown parts.")
-			
-			jsonstr, mdstr = match.groups() 
-
-			#get title string (first heading in markdown string) if available
-			title = re.match(RE_MD_SPLIT_TITLE_BODY,mdstr).group(1)
-			if not title == None:
-				meta["title"] = title
-			
-			#update with explicit json
-			if not jsonstr == None:
-				meta.update(json.loads(jsonstr))
-
-			return meta
+			return get_document(filename).get_metadata()
 		except Exception, e:
 			throw(IOError, "Extracting metadata from file '" + sstr(filename) + "' failed.", e)
 
@@ -4,7 +4,9 @@ import os
 import unittest
 import pkg_resources
 
+from witica.metadata import extractor
 from witica.metadata.extractor import MDExtractor, ImageExtractor
+from witica.metadata.document import get_document
 
 class TestMDExtractor(unittest.TestCase):
 	def setUp(self):
@@ -45,6 +47,28 @@ class TestMDExtractor(unittest.TestCase):
 		self.assertIsInstance(metadata[u"items"], dict)
 		self.assertEqual(metadata[u"items"][u"keys"][0], u">last-modified")
 
+class TestRegistry(unittest.TestCase):
+	def setUp(self):
+		extractor.register_default_extractors()
+
+	def tearDown(self):
+		extractor.unregister_all()
+
+	def test_register(self):
+		self.assertTrue(extractor.is_supported("md"))
+		self.assertFalse(extractor.is_supported("png"))
+		self.assertIs(extractor.get_filetype("md").extractor, extractor.get_filetype("txt").extractor)
+		self.assertRaises(ValueError, extractor.register, "md", MDExtractor)
+
+	def test_precedence(self):
+		item, md, png, jpg = [extractor.get_filetype(ext) for ext in ["item", "md", "png", "jpg"]]
+		self.assertTrue(item.precedes(md))
+		self.assertTrue(png.precedes(jpg))
+		self.assertFalse(jpg.precedes(md))
+
+		extractor.register("markdown", MDExtractor, 40, content = True)
+		self.assertTrue(md.precedes(extractor.get_filetype("markdown")))
+
 class TestImageExtractor(unittest.TestCase):
 	def setUp(self):
 		self.resource_path = pkg_resources.resource_filename("witica","test/files")
@@ -62,3 +86,21 @@ class TestImageExtractor(unittest.TestCase):
 		self.assertEqual(metadata[u"flash"], 0)
 		self.assertEqual(metadata[u"camera"], u'Apple iPhone 5s')
 
+class TestMDDocument(unittest.TestCase):
+	def setUp(self):
+		self.resource_path = pkg_resources.resource_filename("witica","test/files")
+
+	def tearDown(self):
+		pkg_resources.cleanup_resources()
+
+	def test_parsed_once(self):
+		document = get_document(self.resource_path + os.sep + "simple.md")
+		self.assertIs(get_document(self.resource_path + os.sep + "simple.md"), document)
+		self.assertEqual(document.title, u"Title")
+
+	def test_references(self):
+		document = get_document(self.resource_path + os.sep + "links.md")
+		references = [reference for kind, reference, renderparams in document.get_references()]
+		self.assertEqual(references, [u"!simple", u"!öäüß¡““¢≠}{|¢¶“∞…–∞œäö()", u"!./simple"])
+		html = document.get_html(lambda kind, reference: "#" + reference[1:])
+		self.assertTrue('<a href="#simple">linktext</a>' in html)
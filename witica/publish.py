@@ -1,20 +1,52 @@
 from abc import ABCMeta, abstractmethod
 from inspect import isclass, getmembers
 from sys import modules
-import os, json, time
+import os, json, time, hashlib
 from threading import Thread, Lock
 from threading import Event as TEvent
 
 import keyring, getpass
 import ftplib
 
-from witica.util import throw, AsyncWorker, sstr, suni, get_cache_folder, copyfile
+from witica.util import throw, AsyncWorker, sstr, suni, get_cache_folder, copyfile, dropbox_content_hash, open_database
 from witica import util
 from witica import *
 from witica.log import *
 
 cache_folder = get_cache_folder("Target")
 
+class PublishManifest(object):
+	"""Persisted content hashes of the files that were last published to a location"""
+
+	def __init__(self, filename):
+		self._lock = Lock()
+		self._db = open_database(filename)
+		self._db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, hash TEXT)")
+		self._db.commit()
+		self._hashes = dict(self._db.execute("SELECT path, hash FROM files").fetchall())
+
+	def get_hash(self, server_path):
+		with self._lock:
+			return self._hashes.get(suni(server_path))
+
+	def set_hash(self, server_path, content_hash):
+		with self._lock:
+			self._hashes[suni(server_path)] = content_hash
+			self._db.execute("INSERT OR REPLACE INTO files (path, hash) VALUES (?, ?)", (suni(server_path), content_hash))
+			self._db.commit()
+
+	def remove(self, server_path):
+		with self._lock:
+			if self._hashes.pop(suni(server_path), None):
+				self._db.execute("DELETE FROM files WHERE path = ?", (suni(server_path),))
+				self._db.commit()
+
+	def clear(self):
+		with self._lock:
+			self._hashes = {}
+			self._db.execute("DELETE FROM files")
+			self._db.commit()
+
 class Publish(AsyncWorker):
 	__metaclass__ = ABCMeta
 
@@ -27,6 +59,8 @@ class Publish(AsyncWorker):
 		self.state = {}
 		self.publish_id = self.config["publish_id"]
 		self.name = self.source_id + "->" + self.target_id + "@" + self.publish_id
+		self.pending_uploads = {} #server path -> number of queued uploads
+		self.pending_uploads_lock = Lock()
 
 		super(Publish, self).__init__(self.name)
 
@@ -36,27 +70,34 @@ class Publish(AsyncWorker):
 				self.state = json.load(open(self.state_filename),encoding="utf-8")
 				if self.state["version"] != 1:
 					raise IOError("Version of state file " + self.state_filename + " is not compatible. Must be 1.")
-				
-				self.pending_events.clear()
-				for eventJSON in self.state["pendingUploads"]:
-					local_path = eventJSON["local_path"]
-					server_path = eventJSON["server_path"]
-					self.pending_events.append((local_path,server_path))
+
+				if "pendingUploads" in self.state: #migrate queue from state file, unless already moved to the journal
+					if not os.path.isfile(self.journal_filename):
+						self.pending_events.clear()
+						self.pending_events.extend(map(self.event_from_json, self.state["pendingUploads"]))
+					del self.state["pendingUploads"]
+			self.open_journal(self.journal_filename, self.event_to_json, self.event_from_json)
+			for local_path, server_path in self.pending_events:
+				if local_path:
+					self.pending_uploads[server_path] = self.pending_uploads.get(server_path, 0) + 1
+
+			self.manifest = PublishManifest(self.manifest_filename)
+			config_hash = hashlib.md5(json.dumps(self.config, sort_keys=True)).hexdigest()
+			if self.state.get("config_hash") != config_hash: #files were published to another location
+				self.manifest.clear()
+				self.state["config_hash"] = config_hash
+			self.write_state()
 		 except Exception as e:
 		 	throw(IOError, "Loading state file '" + self.state_filename + "' failed.", e)
 
+	def event_to_json(self, event):
+		return {"local_path": event[0], "server_path": event[1]}
+
+	def event_from_json(self, eventJSON):
+		return (eventJSON["local_path"], eventJSON["server_path"])
+
 	def write_state(self):
 		self.state["version"] = 1
-		self.state["pendingUploads"] = []
-
-		toJSON = lambda event: {"local_path": event[0], "server_path": event[1]}
-		self.pending_events_lock.acquire()
-		try:
-			self.state["pendingUploads"] = map(toJSON, self.pending_events)
-		except Exception, e:
-			raise
-		finally:
-			self.pending_events_lock.release()
 
 		s = json.dumps(self.state, encoding="utf-8", indent=3)
 				
@@ -64,15 +105,46 @@ class Publish(AsyncWorker):
 		f.write(s + "\n")
 		f.close()
 
-	def publish_file(self, local_path, server_path):
+	def publish_file(self, local_path, server_path, content_hash = None):
+		"""enqueues the upload of a file, unless the same content was already published to server_path"""
+		if content_hash == None:
+			content_hash = dropbox_content_hash(local_path)
+		with self.pending_uploads_lock:
+			if self.manifest.get_hash(server_path) == content_hash and not server_path in self.pending_uploads: #a pending upload might still fail
+				self.log("Skipped publishing unchanged file '" + sstr(server_path) + "'.", Logtype.DEBUG)
+				return
+			self.manifest.set_hash(server_path, content_hash) #before enqueueing, so that a failed upload can remove it
+			self.pending_uploads[server_path] = self.pending_uploads.get(server_path, 0) + 1
 		self.enqueue_event(self,(local_path,server_path))
 
 	def unpublish_file(self, server_path):
 		self.enqueue_event(self,(None,server_path))
+		self.manifest.remove(server_path)
+
+	def event_failed(self, event, error):
+		local_path, server_path = event
+		with self.pending_uploads_lock:
+			if local_path and self.pending_uploads.get(server_path) == 1: #publish again next time, even if unchanged
+				self.manifest.remove(server_path)
+
+	def finish_event(self, event, error = None):
+		AsyncWorker.finish_event(self, event, error)
+		local_path, server_path = event
+		if local_path:
+			with self.pending_uploads_lock:
+				self.pending_uploads[server_path] -= 1
+				if self.pending_uploads[server_path] == 0:
+					del self.pending_uploads[server_path]
 
 	def get_state_filename(self):
 		return cache_folder + os.sep + self.source_id + "." + self.target_id + "@" + self.publish_id + ".publish"
 
+	def get_journal_filename(self):
+		return cache_folder + os.sep + self.source_id + "." + self.target_id + "@" + self.publish_id + ".journal"
+
+	def get_manifest_filename(self):
+		return cache_folder + os.sep + self.source_id + "." + self.target_id + "@" + self.publish_id + ".manifest"
+
 	@staticmethod
 	def construct_from_json (source_id, target_id, config):
 		classes = Publish.get_classes()
@@ -88,6 +160,8 @@ class Publish(AsyncWorker):
 	    return classes
 
 	state_filename = property(get_state_filename)
+	journal_filename = property(get_journal_filename)
+	manifest_filename = property(get_manifest_filename)
 
 class FolderPublish(Publish):
 	def __init__(self, source_id, target_id, config):
@@ -171,8 +245,8 @@ class FTPPublish(Publish):
 
 			if self.ftp_server.last_error == None:
 				self.log("Successfully uploaded file " + sstr(server_path) + ".", Logtype.DEBUG)
-			else:
-				self.log("Uploading " + sstr(server_path) + " failed: " + sstr(self.ftp_server.last_error), Logtype.ERROR)
+			else: #let event_failed() remove the file from the manifest
+				throw(IOError, "Uploading " + sstr(server_path) + " failed", self.ftp_server.last_error)
 
 		else: #delete file on server
 			self.log("Deleting file " + sstr(server_path) + " on server...", Logtype.DEBUG)
@@ -187,12 +261,12 @@ class FTPPublish(Publish):
 					self.ftp_server.stop()
 				self.ftp_server.idle_event.wait(1)
 
+			if self._stop.is_set():
+				self.ftp_server.stop()
 			if self.ftp_server.last_error == None:
 				self.log("Successfully deleted file " + sstr(server_path) + ".", Logtype.DEBUG)
 			else:
-				self.log("Deleting " + sstr(server_path) + " failed: " + sstr(self.ftp_server.last_error), Logtype.ERROR)
-			if self._stop.is_set():
-				self.ftp_server.stop()
+				throw(IOError, "Deleting " + sstr(server_path) + " failed", self.ftp_server.last_error)
 class FTPServer(Loggable):
 	TIMEOUT = 10
 	BLOCKSIZE=4*16384
@@ -0,0 +1,75 @@
+from threading import Lock
+
+from witica.util import suni, open_database
+from witica.source import SourceItemList
+
+
+class ReferenceGraph(object):
+	"""Persisted references between items, used to find the items that have to be rebuilt when an item is added or removed"""
+
+	def __init__(self, filename):
+		self._lock = Lock()
+		self._db = open_database(filename)
+		self._db.execute("CREATE TABLE IF NOT EXISTS items (item_id TEXT PRIMARY KEY)")
+		self._db.execute("CREATE TABLE IF NOT EXISTS refs (item_id TEXT, pattern TEXT, PRIMARY KEY (item_id, pattern))")
+		self._db.commit()
+		self._references = {} #item_id -> set of referenced item ids or item id patterns
+		self._dependents = {} #item id or item id pattern -> set of item ids referencing it
+		for (item_id,) in self._db.execute("SELECT item_id FROM items"):
+			self._references[item_id] = set()
+		for item_id, pattern in self._db.execute("SELECT item_id, pattern FROM refs"):
+			self._references.setdefault(item_id, set()).add(pattern)
+			self._dependents.setdefault(pattern, set()).add(item_id)
+
+	def contains(self, item_id):
+		"""returns True if the references of the item were recorded"""
+		with self._lock:
+			return suni(item_id) in self._references
+
+	def set_references(self, item_id, patterns):
+		"""records the item ids or patterns referenced by an item"""
+		item_id = suni(item_id)
+		patterns = set([suni(pattern) for pattern in patterns])
+		with self._lock:
+			if self._references.get(item_id) == patterns:
+				return
+			self._remove(item_id)
+			self._references[item_id] = patterns
+			for pattern in patterns:
+				self._dependents.setdefault(pattern, set()).add(item_id)
+			self._db.execute("INSERT INTO items (item_id) VALUES (?)", (item_id,))
+			self._db.executemany("INSERT INTO refs (item_id, pattern) VALUES (?, ?)", [(item_id, pattern) for pattern in patterns])
+			self._db.commit()
+
+	def remove(self, item_id):
+		with self._lock:
+			self._remove(suni(item_id))
+			self._db.commit()
+
+	def _remove(self, item_id):
+		"""removes an item, must be called while holding the lock"""
+		for pattern in self._references.pop(item_id, set()):
+			self._dependents[pattern].discard(item_id)
+			if len(self._dependents[pattern]) == 0:
+				del self._dependents[pattern]
+		self._db.execute("DELETE FROM items WHERE item_id = ?", (item_id,))
+		self._db.execute("DELETE FROM refs WHERE item_id = ?", (item_id,))
+
+	def get_dependents(self, item_id):
+		"""returns the ids of all items with a reference matching item_id"""
+		item_id = suni(item_id)
+		with self._lock:
+			dependents = set()
+			for pattern, items in self._dependents.iteritems():
+				if pattern == item_id or SourceItemList.match(pattern, item_id):
+					dependents.update(items)
+			dependents.discard(item_id)
+			return dependents
+
+	def clear(self):
+		with self._lock:
+			self._references = {}
+			self._dependents = {}
+			self._db.execute("DELETE FROM items")
+			self._db.execute("DELETE FROM refs")
+			self._db.commit()
@@ -1,7 +1,8 @@
-import os, json, shutil, glob, calendar, codecs, fnmatch, re, unicodedata, errno
+import os, json, shutil, glob, calendar, codecs, fnmatch, re, unicodedata, errno, itertools, zipfile, time, copy
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Condition
+from multiprocessing.pool import ThreadPool
 from collections import Iterable
 from stat import *
 from inspect import isclass, getmembers
@@ -11,10 +12,13 @@ from sys import modules
 import dropbox
 from dropbox import Dropbox, DropboxOAuth2FlowNoRedirect, files
 
-from witica.util import Event, KillableThread, sstr, suni, throw, get_cache_folder
+from witica.util import Event, sstr, suni, throw, get_cache_folder
 from witica import *
 from witica.log import *
 from witica.metadata import extractor
+from witica.metadata.document import get_document
+from witica.index import ItemIndex, normalize_path
+from witica import inotify
 
 
 cache_folder = get_cache_folder("Source")
@@ -24,10 +28,13 @@ class Source(Loggable):
 
 	__metaclass__ = ABCMeta
 
+	lower_case_ids = True #item ids are lower case, so references are converted to lower case before resolving them
+
 	def __init__(self, source_id, config, prefix = ""):
 		self.source_id = source_id
 		self.prefix = prefix
 
+		self.index = ItemIndex(self)
 		self.items = SourceItemList(self)
 		self.log_id = source_id
 		self.changeEvent = Event()
@@ -50,12 +57,7 @@ class Source(Loggable):
 
 		if self.continuous == False: #fetch changes only once
 			try:
-				cursor = self.fetch_changes(self.changeEvent, self.state["cursor"])
-
-				if not(cursor == None):
-					self.state["cursor"] = cursor
-					self.cursorEvent(self,self.state["cursor"])
-					self.write_state()
+				self.fetch_changes(self.changeEvent, self.state["cursor"], self.save_cursor)
 			except Exception, e:
 				self.log_exception("Fetching changes failed.", Logtype.ERROR)
 		else: #fetch changes continously
@@ -65,27 +67,31 @@ class Source(Loggable):
 
 				if self.changes_available:
 					try:
-						cursor = self.fetch_changes(self.changeEvent, self.state["cursor"])
-						if cursor:
-							self.state["cursor"] = cursor
-							self.cursorEvent(self,self.state["cursor"])
-							self.write_state()
+						self.fetch_changes(self.changeEvent, self.state["cursor"], self.save_cursor)
 					except Exception, e:
 						self.log_exception("Fetching changes failed.", Logtype.ERROR)
 		self.stoppedEvent(self,None)
 		self.log("Worker thread stopped.", Logtype.DEBUG)
 
+	def save_cursor(self, sender, cursor):
+		"""checkpoints the cursor up to which changes have been passed to the targets"""
+		self.state["cursor"] = cursor
+		self.cursorEvent(self,self.state["cursor"])
+		self.write_state()
+
 	def stop(self):
 		self._stop.set()
+		self.index.flush()
 
 	def get_item_id(self,path):
 		return path.split(".")[0].split("@")[0] #id is the path until first @ or .
 
 	def item_exists(self,item_id):
-		return SourceItem(self,item_id).exists
+		return self.index.exists(item_id)
 
 	def resolve_reference(self, reference, item, allow_patterns = False):
-		reference = reference.lower()
+		if self.lower_case_ids:
+			reference = reference.lower()
 		if re.match(extractor.RE_ITEM_REFERENCE, reference):
 			itempattern = SourceItemList.absolute_itemid(reference[1:], item)
 
@@ -104,6 +110,21 @@ class Source(Loggable):
 		else:
 			raise ValueError("'" + reference + "' is not a valid reference")
 
+	def fire_change_event(self, path, change_event, deleted = False):
+		"""fires the change event for a file in the source that was changed or deleted"""
+		if re.match(extractor.RE_METAFILE, path): #site metadata change
+			self.log("Metafile changed: " + sstr(path), Logtype.INFO)
+			change_event(self,MetaChanged(self,path.partition("meta/")[2]))
+		elif re.match(extractor.RE_ITEMFILE, path):
+			if self.item_exists(self.get_item_id(path)):
+				self.log("Item changed: " + sstr(path), Logtype.INFO)
+				change_event(self,ItemChanged(self, self.get_item_id(path), path))
+			else:
+				self.log("Item removed: " + sstr(path), Logtype.INFO)
+				change_event(self,ItemRemoved(self, self.get_item_id(path)))
+		elif not deleted:
+			self.log("File '" + path + "' is not supported and will be ignored. Filenames containing '@' are currently not supported.", Logtype.WARNING)
+
 	def get_local_path(self, absolutepath):
 		if absolutepath.startswith(self.get_absolute_path("")):
 			i = len(self.get_absolute_path(""))
@@ -175,7 +196,8 @@ class Source(Loggable):
 		pass
 
 	@abstractmethod
-	def fetch_changes(self):
+	def fetch_changes(self, change_event, cursor = None, cursor_event = None):
+		doc = "Fires change_event for all changes since cursor and cursor_event with the new cursor after each batch of changes, returns the final cursor"
 		pass
 
 	@abstractmethod
@@ -196,13 +218,20 @@ class DropboxSource(Source):
 
 		self.source_dir = cache_folder + os.sep + self.source_id
 		self.state_filename = cache_folder + os.sep + self.source_id + ".source"
+		self.index_filename = cache_folder + os.sep + self.source_id + ".index"
 
 		self.app_key = config["app_key"]
 		self.app_secret = config["app_secret"]
+		self.download_workers = config["download_workers"] if "download_workers" in config else 4
+		self.zip_bootstrap = config["zip_bootstrap"] if "zip_bootstrap" in config else True
+		self.poller = None
 
 	def start_session(self):		
 		self.state = {}
 		self.load_state()
+		if not(os.path.isdir(cache_folder)):
+			os.makedirs(cache_folder)
+		self.index.open(self.index_filename, self.cache_cursor)
 
 		try:
 			self.dbx = Dropbox(self.state["access_token"])
@@ -248,6 +277,8 @@ class DropboxSource(Source):
 		if not(os.path.isdir(self.source_dir)):
 			os.makedirs(self.source_dir)
 
+		self.index.commit(self.cache_cursor)
+
 		s = json.dumps(self.state, indent=3, encoding="utf-8") + "\n"		
 		f = codecs.open(self.state_filename, "w", encoding="utf-8")
 		f.write(s)
@@ -277,119 +308,297 @@ class DropboxSource(Source):
 		self.write_state()
 
 	def update_cache(self):
+		listed_paths = None #paths in a full listing, only used when reconciling the existing cache
 		if os.path.isdir(self.source_dir):
+			pages = self.iter_delta(self.cache_cursor)
 			try:
-				delta = self.dbx.files_list_folder_continue(self.cache_cursor)
+				delta = next(pages)
 			except Exception as e:
-				self.log_exception("Could not use delta. Trying to rebuild the cache.", Logtype.WARNING)
-				shutil.rmtree(self.source_dir)
-				os.makedirs(self.source_dir)
-				delta = self.dbx.files_list_folder(path = self.path_prefix if not self.path_prefix == "" else None, recursive=True)
+				self.log_exception("Could not use delta. Trying to reconcile the cache with a full listing.", Logtype.WARNING)
+				listed_paths = set()
+				pages = self.iter_delta(None)
+				delta = next(pages)
 		else:
 			os.makedirs(self.source_dir)
-			delta = self.dbx.files_list_folder(path = self.path_prefix if not self.path_prefix == "" else None, recursive=True)
+			self.index.clear()
+			bootstrapped = self.bootstrap_cache()
+			if bootstrapped:
+				self.cache_cursor = bootstrapped[1]
+				self.write_state()
+				self.log("Cache bootstrapped from zip archive.", Logtype.DEBUG)
+				return
+			if self._stop.is_set(): return
+			pages = self.iter_delta(None)
+			delta = next(pages)
 
+		filecount = 0
+		for delta in itertools.chain([delta], pages):
+			if self._stop.is_set(): return
+
+			filecount += self.update_cache_entries(delta.entries, listed_paths)
+			if self._stop.is_set(): return
+
+			if listed_paths == None: #when reconciling, the cursor is only valid after the complete listing was processed
+				self.cache_cursor = delta.cursor
+				self.write_state()
 		if self._stop.is_set(): return
 
-		#update cache
-		filecount = 0
-		for metadata in delta.entries:
-			path = unicodedata.normalize("NFC",unicode(metadata.path_lower))
-			if path.startswith(self.path_prefix):
-				path = path[len(self.path_prefix):]
+		if listed_paths != None:
+			self.remove_unlisted_files(listed_paths)
+			self.cache_cursor = delta.cursor
+			self.write_state()
 
-			if isinstance(metadata, files.DeletedMetadata): #deleted file or directory
-				if os.path.exists(self.source_dir + path):
-					if os.path.isdir(self.source_dir + path):
-						try:
-							shutil.rmtree(self.source_dir + path)
-						except Exception, e:
-							if not(e.errno == errno.ENOENT): #don't treat as error, if file didn't exist
-								self.log_exception("Directory '" + self.source_dir + path + "' in source cache could not be removed.", Logtype.WARNING)
-					else:
+		self.log("Cache updated. Updated files: " + sstr(filecount), Logtype.DEBUG)
+
+	def iter_delta(self, cursor):
+		"""yields the pages of the changes since cursor (or of a full listing if there is no cursor) one by one"""
+		if cursor:
+			delta = self.dbx.files_list_folder_continue(cursor)
+		else:
+			delta = self.dbx.files_list_folder(path = self.path_prefix if not self.path_prefix == "" else None, recursive=True)
+		yield delta
+
+		while delta.has_more and not self._stop.is_set():
+			delta = self.dbx.files_list_folder_continue(delta.cursor)
+			yield delta
+
+	def update_cache_entries(self, entries, listed_paths = None):
+		"""applies the entries of a delta to the cache and returns the number of downloaded files"""
+		pool = ThreadPool(self.download_workers)
+		downloads = {} #path -> result of pending download
+		try:
+			for metadata in entries:
+				path = unicodedata.normalize("NFC",unicode(metadata.path_lower))
+				if path.startswith(self.path_prefix):
+					path = path[len(self.path_prefix):]
+
+				if isinstance(metadata, files.DeletedMetadata): #deleted file or directory
+					self.wait_for_downloads(downloads, path) #don't let a pending download recreate the file
+					self.remove_cached_path(path)
+
+				elif isinstance(metadata, files.FolderMetadata): #directory
+					if listed_paths != None:
+						listed_paths.add(path)
+					if not(os.path.exists(self.source_dir + path)):
 						try:
-							os.remove(self.source_dir + path)
+							os.makedirs(self.source_dir + path)
 						except Exception, e:
-							if not(e.errno == errno.ENOENT): #don't treat as error, if file didn't exist
-								self.log_exception("File '" + self.source_dir + path + "' in source cache could not be removed.", Logtype.WARNING)
+							self.log_exception("Directory '" + self.source_dir + path + "' in source cache could not be created.", Logtype.ERROR)
 
-			elif isinstance(metadata, files.FolderMetadata): #directory
-				if not(os.path.exists(self.source_dir + path)):
-					try:
-						os.makedirs(self.source_dir + path)
-					except Exception, e:
-						self.log_exception("Directory '" + self.source_dir + path + "' in source cache could not be created.", Logtype.ERROR)
+				elif isinstance(metadata, files.FileMetadata): #new/changed file
+					if listed_paths != None:
+						listed_paths.add(path)
+					self.wait_for_downloads(downloads, path)
+					downloads[path] = pool.apply_async(self.download_file, (path, metadata))
 
-			elif isinstance(metadata, files.FileMetadata): #new/changed file
-				self.log("Downloading '" + path + "'...", Logtype.DEBUG)
-				try:
-					#download file
-					self.dbx.files_download_to_file(self.source_dir + path, self.path_prefix + path)
+				if self._stop.is_set(): break
+		finally:
+			pool.close()
+			pool.join() #wait until all files of this delta have landed
 
-					#set modified time
-					try:
-						mtime = calendar.timegm(metadata.server_modified.timetuple())
-						st = os.stat(self.source_dir + path)
-						atime = st[ST_ATIME]
-						os.utime(self.source_dir + path,(atime,mtime))
-					except Exception, e:
-						self.log_exception("The original modification date of file '" + sstr(path) + "' couldn't be extracted. Using current time instead.", Logtype.WARNING)
+		return len([path for path, result in downloads.items() if result.get()])
 
-					filecount += 1				
+	def remove_cached_path(self, path):
+		if os.path.exists(self.source_dir + path):
+			if os.path.isdir(self.source_dir + path):
+				try:
+					shutil.rmtree(self.source_dir + path)
 				except Exception, e:
-					self.log_exception("Downloading '" + sstr(self.path_prefix + path) + "' failed (skipping file).", Logtype.ERROR)
+					if not(e.errno == errno.ENOENT): #don't treat as error, if file didn't exist
+						self.log_exception("Directory '" + self.source_dir + path + "' in source cache could not be removed.", Logtype.WARNING)
+			else:
+				try:
+					os.remove(self.source_dir + path)
+				except Exception, e:
+					if not(e.errno == errno.ENOENT): #don't treat as error, if file didn't exist
+						self.log_exception("File '" + self.source_dir + path + "' in source cache could not be removed.", Logtype.WARNING)
+		self.index.remove_path(path[1:])
+
+	def remove_unlisted_files(self, listed_paths):
+		"""removes all files and directories from the cache that were not part of a full listing"""
+		for root, dirs, filenames in os.walk(self.source_dir, topdown=False):
+			for name in filenames + dirs:
+				path = "/" + normalize_path(os.path.join(root, name)[len(self.source_dir)+1:])
+				if not path in listed_paths and os.path.lexists(self.source_dir + path):
+					self.log("Removing '" + path + "' from cache, because it doesn't exist in the source anymore.", Logtype.DEBUG)
+					self.remove_cached_path(path)
+
+	def download_file(self, path, metadata):
+		"""downloads a file into the cache if it changed, returns True if the file was downloaded"""
+		if self._stop.is_set(): return False
 
-			if self._stop.is_set(): return
-		
-		self.cache_cursor = delta.cursor
-		self.write_state()
+		try:
+			#download file, unless the cached file has the same content
+			downloaded = False
+			if not(os.path.isfile(self.source_dir + path) and metadata.content_hash \
+					and self.index.get_content_hash(path[1:]) == metadata.content_hash):
+				self.log("Downloading '" + path + "'...", Logtype.DEBUG)
+				self.dbx.files_download_to_file(self.source_dir + path, self.path_prefix + path)
+				downloaded = True
 
-		if delta.has_more:
-			self.update_cache()
+			self.set_mtime(path, metadata)
+			self.index.add_file(path[1:], metadata.content_hash)
+			return downloaded
+		except Exception, e:
+			self.log_exception("Downloading '" + sstr(self.path_prefix + path) + "' failed (skipping file).", Logtype.ERROR)
+			return False
 
-		self.log("Cache updated. Updated files: " + sstr(filecount), Logtype.DEBUG)
+	def bootstrap_cache(self):
+		"""populates the empty cache by downloading the whole folder as a single zip archive,
+		returns the entries and cursor of the listing or None if the files need to be downloaded one by one"""
+		if not self.zip_bootstrap or self.path_prefix == "": #the root of a Dropbox can't be downloaded as zip
+			return None
 
-	def update_change_status(self):
-		self.changes_available = False
-		t = KillableThread(target=self.update_change_status_blocking, name=self.source_id + " Dropbox (longpoll)")
-		t.start()
-		while t.isAlive():
-			if self._stop.is_set():
-				try:
-					t.kill()
-				except Exception, e:
-					self.log_exception(e)
-					pass
-			t.join(1)
+		entries = []
+		for delta in self.iter_delta(None):
+			entries.extend(delta.entries)
+			cursor = delta.cursor
+		if self._stop.is_set(): return None
+
+		listed_files = {} #path -> metadata
+		for metadata in entries:
+			path = unicodedata.normalize("NFC",unicode(metadata.path_lower))
+			if path.startswith(self.path_prefix):
+				path = path[len(self.path_prefix):]
+			if isinstance(metadata, files.FolderMetadata) and not(os.path.exists(self.source_dir + path)):
+				os.makedirs(self.source_dir + path)
+			elif isinstance(metadata, files.FileMetadata):
+				listed_files[path] = metadata
 
-	def update_change_status_blocking(self):
+		zip_filename = self.source_dir + ".zip"
+		try:
+			self.log("Downloading '" + sstr(self.path_prefix) + "' as zip archive...", Logtype.DEBUG)
+			self.dbx.files_download_zip_to_file(zip_filename, self.path_prefix)
+			if self._stop.is_set(): return None
+			self.extract_zip(zip_filename, listed_files)
+		except Exception, e:
+			self.log_exception("Downloading the source as zip archive failed. Downloading files one by one instead.", Logtype.WARNING)
+			return None
+		finally:
+			if os.path.exists(zip_filename):
+				os.remove(zip_filename)
+
+		return entries, cursor
+
+	def extract_zip(self, zip_filename, listed_files):
+		"""extracts the files of the listing from a zip archive of the source folder into the cache"""
+		with zipfile.ZipFile(zip_filename) as archive:
+			for info in archive.infolist():
+				name = info.filename.decode("utf-8") if isinstance(info.filename, str) else info.filename
+				path = "/" + unicodedata.normalize("NFC", name.partition("/")[2].lower()) #strip top level folder
+				if not path in listed_files: #directory or file not in listing
+					continue
+				if self._stop.is_set(): return
+
+				if not(os.path.isdir(os.path.dirname(self.source_dir + path))):
+					os.makedirs(os.path.dirname(self.source_dir + path))
+				with open(self.source_dir + path, "wb") as f:
+					shutil.copyfileobj(archive.open(info), f)
+				metadata = listed_files.pop(path)
+				self.set_mtime(path, metadata)
+				self.index.add_file(path[1:], metadata.content_hash)
+
+		for path, metadata in listed_files.items(): #files missing in the archive
+			self.download_file(path, metadata)
+
+	def set_mtime(self, path, metadata):
+		"""sets the modification time of a cached file to the one in Dropbox"""
+		try:
+			mtime = calendar.timegm(metadata.server_modified.timetuple())
+			st = os.stat(self.source_dir + path)
+			atime = st[ST_ATIME]
+			os.utime(self.source_dir + path,(atime,mtime))
+		except Exception, e:
+			self.log_exception("The original modification date of file '" + sstr(path) + "' couldn't be extracted. Using current time instead.", Logtype.WARNING)
+
+	def wait_for_downloads(self, downloads, path):
+		"""waits until all pending downloads of the file or directory at path are finished"""
+		for download_path, result in downloads.items():
+			if download_path == path or download_path.startswith(path + "/"):
+				result.wait()
+
+	def update_change_status(self):
 		if self.state["cursor"]:
-			try:
-				delta = self.dbx.files_list_folder_longpoll(self.state["cursor"],30)
-				self.changes_available = delta.changes
-			except Exception, e:
-				self.changes_available = False
+			if self.poller == None:
+				self.poller = DropboxChangePoller(self)
+			self.changes_available = self.poller.wait_for_changes(self.state["cursor"])
 		else:
 			self.changes_available = True
 
-	def fetch_changes(self,change_event, cursor=None):
-		global cache_folder
+	def stop(self):
+		super(DropboxSource, self).stop()
+		if self.poller:
+			self.poller.cancel()
+
+	def fetch_changes(self, change_event, cursor = None, cursor_event = None):
+		if not cursor:
+			cursor = None
+
+		if cursor == (self.cache_cursor or None) and (cursor != None or not os.path.isdir(self.source_dir)):
+			#cursor is in sync with the cache, update the cache and fire the change events in a single pass
+			if not os.path.isdir(self.source_dir):
+				os.makedirs(self.source_dir)
+				self.index.clear()
+				bootstrapped = self.bootstrap_cache()
+				if bootstrapped:
+					entries, cursor = bootstrapped
+					self.fire_change_events(entries, change_event)
+					if self._stop.is_set(): return
+
+					self.cache_cursor = cursor
+					if cursor_event:
+						cursor_event(self, cursor)
+					else:
+						self.write_state()
+					return cursor
+				if self._stop.is_set(): return
+
+			pages = self.iter_delta(cursor)
+			try:
+				delta = next(pages)
+			except Exception as e:
+				self.log_exception("Could not use delta.", Logtype.WARNING)
+				return self.fetch_lagging_changes(change_event, cursor, cursor_event)
+
+			self.log("Fetching changes...", Logtype.DEBUG)
+			for delta in itertools.chain([delta], pages):
+				filecount = self.update_cache_entries(delta.entries)
+				if self._stop.is_set(): return
+				self.log("Cache updated. Updated files: " + sstr(filecount), Logtype.DEBUG)
+
+				self.fire_change_events(delta.entries, change_event)
+				if self._stop.is_set(): return
+
+				cursor = delta.cursor
+				self.cache_cursor = cursor
+				if cursor_event:
+					cursor_event(self, cursor)
+				else:
+					self.write_state()
+
+			return cursor
+		else:
+			return self.fetch_lagging_changes(change_event, cursor, cursor_event)
 
+	def fetch_lagging_changes(self, change_event, cursor = None, cursor_event = None):
+		"""brings the cache up to date and then fires the change events since cursor, which lags behind the cache"""
 		self.update_cache()
 		if self._stop.is_set(): return
 
 		self.log("Fetching changes...", Logtype.DEBUG)
 
-		if cursor == "":
-			cursor = None
+		for delta in self.iter_delta(cursor):
+			self.fire_change_events(delta.entries, change_event)
+			if self._stop.is_set(): return
 
-		if cursor != None:
-			delta = self.dbx.files_list_folder_continue(cursor)
-		else:
-			delta = self.dbx.files_list_folder(path = self.path_prefix if not self.path_prefix == "" else None, recursive=True)
+			cursor = delta.cursor
+			if cursor_event:
+				cursor_event(self, cursor)
 
-		#fire change events
-		for metadata in delta.entries:
+		return cursor
+
+	def fire_change_events(self, entries, change_event):
+		for metadata in entries:
 			path = unicodedata.normalize("NFC", unicode(metadata.path_lower))
 			if path.startswith(self.path_prefix):
 				path = path[len(self.path_prefix):]
@@ -397,34 +606,75 @@ class DropboxSource(Source):
 				path = path[1:]
 
 			if isinstance(metadata, files.FileMetadata) or isinstance(metadata, files.DeletedMetadata):
-				if re.match(extractor.RE_METAFILE, path): #site metadata change
-					self.log("Metafile changed: " + sstr(path), Logtype.INFO)
-					change_event(self,MetaChanged(self,path.partition("meta/")[2]))
-				elif re.match(extractor.RE_ITEMFILE, path):
-					item = SourceItem(self, self.get_item_id(path))
-					if item.exists:
-						self.log("Item changed: " + sstr(path), Logtype.INFO)
-						change_event(self,ItemChanged(self, self.get_item_id(path), path))
-					else:
-						self.log("Item removed: " + sstr(path), Logtype.INFO)
-						change_event(self,ItemRemoved(self, self.get_item_id(path)))
-				elif isinstance(metadata, files.FileMetadata):
-					self.log("File '" + path + "' is not supported and will be ignored. Filenames containing '@' are currently not supported.", Logtype.WARNING)
+				self.fire_change_event(path, change_event, deleted = isinstance(metadata, files.DeletedMetadata))
 
 			if self._stop.is_set(): return
 
-		cursor = delta.cursor
-		if delta.has_more:
-			cursor = self.fetch_changes(change_event, delta.cursor)
-		
-		return cursor
-
 	def get_abs_meta_filename(self, local_filename):
 		return self.get_absolute_path(os.path.join('meta' + os.sep + local_filename))
 
 	def get_absolute_path(self, localpath):
 		return os.path.abspath(os.path.join(self.source_dir, localpath))
 
+class DropboxChangePoller(object):
+	"""Long-lived thread that waits for changes in a Dropbox folder using longpoll requests"""
+
+	TIMEOUT = 30 #seconds a longpoll request waits for changes
+	ERROR_BACKOFF = 5 #seconds to wait before polling again after a failed request
+
+	def __init__(self, source):
+		self.source = source
+		self._condition = Condition()
+		self._cursor = None #cursor to poll for changes
+		self._result = None #True if there are changes since the cursor, None while polling
+		self._cancelled = False
+		self._thread = Thread(target=self.work, name=source.source_id + " Dropbox (longpoll)")
+		self._thread.daemon = True #a pending request must not prevent witica from exiting
+		self._thread.start()
+
+	def wait_for_changes(self, cursor):
+		"""blocks until a longpoll request for cursor returned or the poller was cancelled, returns True if changes are available"""
+		with self._condition:
+			if self._cursor != cursor:
+				self._cursor = cursor
+				self._result = None
+				self._condition.notify_all()
+			while self._result == None and not self._cancelled:
+				self._condition.wait()
+			result, self._result = self._result, None
+			if result:
+				self._cursor = None #cursor is outdated once the changes were fetched, wait for the next one
+			self._condition.notify_all()
+			return bool(result) and not self._cancelled
+
+	def cancel(self):
+		with self._condition:
+			self._cancelled = True
+			self._condition.notify_all()
+
+	def work(self):
+		backoff = 0
+		while True:
+			with self._condition:
+				deadline = time.time() + backoff
+				while not self._cancelled and (self._result != None or self._cursor == None or time.time() < deadline):
+					self._condition.wait(max(deadline - time.time(), 0) or None)
+				if self._cancelled:
+					return
+				cursor = self._cursor
+
+			try:
+				result = self.source.dbx.files_list_folder_longpoll(cursor, self.TIMEOUT)
+				changes, backoff = result.changes, result.backoff or 0
+			except Exception, e:
+				self.source.log_exception("Waiting for changes in Dropbox failed.", Logtype.WARNING)
+				changes, backoff = False, self.ERROR_BACKOFF
+
+			with self._condition:
+				if self._cursor == cursor:
+					self._result = changes
+					self._condition.notify_all()
+
 class DropboxAppFolder(DropboxSource): #TODO: remove (legacy)
 	def __init__(self, source_id, config, prefix = ""):
 		super(DropboxAppFolder, self).__init__(source_id, config, prefix)
@@ -437,6 +687,172 @@ class DropboxFolder(DropboxSource):
 		self.path_prefix = unicodedata.normalize("NFC",config["folder"].lower())
 		self.start_session()
 
+class LocalFolder(Source):
+	doc = "Folder on the local disk containing a witica source"
+
+	lower_case_ids = False #item ids keep the case of the file names
+
+	POLL_INTERVAL = 2 #seconds between scans of the folder, when inotify is not available
+	SETTLE_TIME = 0.1 #seconds to wait for further events, so that files saved together are fetched together
+
+	def __init__(self, source_id, config, prefix = ""):
+		super(LocalFolder, self).__init__(source_id, config, prefix)
+
+		self.source_dir = os.path.abspath(os.path.expanduser(config["path"]))
+		if not(os.path.isdir(self.source_dir)):
+			raise IOError("Source folder '" + sstr(self.source_dir) + "' does not exist.")
+		self.state_filename = cache_folder + os.sep + self.source_id + ".source"
+		self.index_filename = cache_folder + os.sep + self.source_id + ".index"
+
+		self.watcher = None
+		self.rescan = True #if True, the whole folder is compared with the index on next update
+		self.changed_paths = set() #files changed since the cursor, that were not passed to the targets yet
+		self.changes_available = False
+
+		if not(os.path.isdir(cache_folder)):
+			os.makedirs(cache_folder)
+		self.state = {}
+		self.load_state()
+		#the persisted index is the snapshot of the folder at the cursor, changes made while witica
+		#was not running are detected by comparing the folder with it
+		self.index.open(self.index_filename, self.state["cursor"])
+
+		self.log("Initialized source.", Logtype.DEBUG)
+
+	def load_state(self):
+		if os.path.isfile(self.state_filename):
+			self.state = json.loads(codecs.open(self.state_filename, "r", "utf-8").read())
+			if self.state["version"] != 1:
+				raise IOError("Version of source state file is not compatible. Should be 1 but is " + str(self.state["version"]) + ".")
+		else:
+			self.state["version"] = 1
+			self.state["cursor"] = ""
+
+	def write_state(self):
+		self.index.commit(self.state["cursor"])
+
+		s = json.dumps(self.state, indent=3, encoding="utf-8") + "\n"
+		f = codecs.open(self.state_filename, "w", encoding="utf-8")
+		f.write(s)
+		f.close()
+
+	def stop(self):
+		#the index is not flushed here, it must only be written together with the cursor it is the snapshot of
+		self._stop.set()
+
+	def is_ignored(self, local_path):
+		"""hidden files and directories (i.e. temporary files of editors) are not part of the source"""
+		return any(name.startswith(".") for name in local_path.split("/"))
+
+	def scan(self, local_path = ""):
+		"""compares the files at or below local_path with the index, updates the index and returns the paths of all changed files"""
+		changed = set()
+		prefix = local_path + "/" if local_path else ""
+		indexed = set([path for path in self.index.get_paths() if (path == local_path or path.startswith(prefix)) and not self.is_ignored(path)])
+
+		root = self.source_dir.encode("utf-8") if isinstance(self.source_dir, unicode) else self.source_dir
+		abspath = os.path.join(root, local_path.encode("utf-8")) if local_path else root
+		if os.path.isdir(abspath):
+			filenames = []
+			for dirpath, dirs, names in os.walk(abspath):
+				dirs[:] = [d for d in dirs if not d.startswith(".")]
+				filenames.extend([os.path.join(dirpath, name) for name in names if not name.startswith(".")])
+		elif os.path.isfile(abspath):
+			filenames = [abspath]
+		else:
+			filenames = []
+
+		for filename in filenames:
+			path = normalize_path(filename[len(root)+1:])
+			indexed.discard(path)
+			try:
+				st = os.stat(filename)
+			except OSError:
+				continue #file was removed in the meantime
+			if self.index.get_file_stat(path) != (st.st_mtime, st.st_size):
+				self.index.add_file(filename[len(root)+1:])
+				changed.add(path)
+
+		for path in indexed: #files that don't exist anymore
+			self.index.remove_path(path)
+			changed.add(path)
+		return changed
+
+	def update_cache(self):
+		"""applies the changes in the folder since the last update to the index"""
+		paths, overflowed = self.watcher.pop_changes() if self.watcher else (set(), False)
+		if self.watcher == None or overflowed or self.rescan:
+			self.rescan = False
+			paths = [""]
+		for path in paths:
+			path = normalize_path(path)
+			if not self.is_ignored(path):
+				self.changed_paths.update(self.scan(path))
+
+	def update_change_status(self):
+		self.changes_available = False
+		if self.watcher == None and inotify.is_supported():
+			try:
+				self.watcher = inotify.TreeWatcher(self.source_dir)
+				self.rescan = True #changes before the watch was set up could be missed otherwise
+			except Exception, e:
+				self.log_exception("Watching the source folder failed. Polling for changes instead.", Logtype.WARNING)
+
+		if self.watcher == None: #poll
+			self._stop.wait(self.POLL_INTERVAL)
+			self.changes_available = True
+		elif self.rescan:
+			self.changes_available = True
+		else:
+			while not self._stop.is_set():
+				if self.watcher.wait(1):
+					self.watcher.wait(self.SETTLE_TIME)
+					self.changes_available = True
+					return
+			self.watcher.close()
+			self.watcher = None
+
+	def fetch_changes(self, change_event, cursor = None, cursor_event = None):
+		self.update_cache()
+		if self._stop.is_set(): return
+
+		in_sync = (cursor or "") == self.state["cursor"]
+		if in_sync and cursor:
+			paths = set(self.changed_paths)
+			if len(paths) == 0:
+				return cursor
+		else: #no changes are recorded before the current cursor, so all files are passed as changed
+			paths = self.changed_paths | set(self.index.get_paths())
+
+		self.log("Fetching changes...", Logtype.DEBUG)
+		for path in sorted(paths):
+			if not self.is_ignored(path):
+				self.fire_change_event(path, change_event, deleted = not(os.path.isfile(self.get_absolute_path(path))))
+			if self._stop.is_set(): return
+
+		if in_sync:
+			self.changed_paths -= paths
+			cursor = unicode(int(self.state["cursor"] or 0) + 1)
+			if cursor_event:
+				cursor_event(self, cursor)
+			else:
+				self.state["cursor"] = cursor
+				self.write_state()
+		else:
+			cursor = self.state["cursor"]
+			if cursor_event:
+				cursor_event(self, cursor)
+		return cursor
+
+	def get_abs_meta_filename(self, local_filename):
+		return self.get_absolute_path(os.path.join('meta' + os.sep + local_filename))
+
+	def get_absolute_path(self, localpath):
+		return os.path.abspath(os.path.join(self.source_dir, localpath))
+
+compiled_patterns = {} #itemid pattern -> compiled regular expression
+UNKNOWN = object() #marks memoized values of a SourceItem that were not computed yet
+
 class SourceItemList(object):
 	"""An iteratable that allows to access all items in a source"""
 
@@ -453,46 +869,46 @@ class SourceItemList(object):
 			raise(TypeError("The type '" + key.__class__.__name__ + "'' is not supported. Use 'str' instead to access items."))
 
 	def __len__(self):
-		count = 0
-		for item in self:
-			count += 1
-		
-		return count
+		return len(self.source.index)
 
 	def __iter__(self):
-		for root, dirs, files in os.walk(self.source.get_absolute_path(""), topdown=True):
-			last_item_id = ""
-			for filename in files:
-				local_path = self.source.get_local_path(os.path.join(root,filename))
-				item_id = re.match(extractor.RE_ITEM_SPLIT_ITEMID_EXTENSION, local_path)
-				if item_id:
-					item_id = item_id.group(1)
-					if self.source.item_exists(item_id) and item_id != last_item_id: #only yield valid items and only once
-						yield SourceItem(self.source, item_id)
-						last_item_id = item_id
-				
+		for item_id in self.source.index.get_item_ids():
+			yield SourceItem(self.source, item_id)
+
+	@staticmethod
+	def compile_pattern(pattern):
+		"""returns the compiled regular expression for an itemid pattern (that can contain *, ** or ? as placeholders)"""
+		regex = compiled_patterns.get(pattern)
+		if regex == None:
+			tokenized = re.split(r"(\*\*|\*|\?)", pattern)
+			regex = ""
+			for token in tokenized:
+				if token == "**": #matches all character sequences
+					regex += "[\s\S]*"
+				elif token == "*": #matches all character sequences that don't contain /
+					regex += "[^\/]*"
+				elif token == "?": #matches any single character
+					regex += "[\s\S]"
+				else: #escape the remaining strings
+					regex += re.escape(token)
+			regex = re.compile("^" + regex + "$")
+			if len(compiled_patterns) >= 1000:
+				compiled_patterns.clear()
+			compiled_patterns[pattern] = regex
+		return regex
+
 	@staticmethod
 	def match(pattern, itemid):
 		"""checks if an itemid matches a specific itemid pattern (that can contain *, ** or ? as placeholders"""
-		tokenized = re.split(r"(\*\*|\*|\?)", pattern)
-		regex = ""
-		for token in tokenized:
-			if token == "**": #matches all character sequences
-				regex += "[\s\S]*"
-			elif token == "*": #matches all character sequences that don't contain /
-				regex += "[^\/]*"
-			elif token == "?": #matches any single character
-				regex += "[\s\S]"
-			else: #escape the remaining strings
-				regex += re.escape(token)
-		if re.match("^" + regex + "$", itemid):
+		if SourceItemList.compile_pattern(pattern).match(itemid):
 			return True
 		else:
 			return False
 
 	@staticmethod
 	def absolute_itemid(relative_itemid, current_item):
-		relative_itemid = relative_itemid.lower()
+		if current_item.source.lower_case_ids:
+			relative_itemid = relative_itemid.lower()
 		if relative_itemid.startswith("./"): #expand relative item id
 			prefix = current_item.item_id.rpartition("/")[0]
 			if prefix != "":
@@ -504,39 +920,52 @@ class SourceItemList(object):
 
 	def get_items(self, itemidpattern):
 		"""Returns all items where the itemid expression matches. The expression can contain * as placeholder."""
-		return [item for item in self if SourceItemList.match(itemidpattern, item.item_id)]
+		prefix = re.split(r"\*|\?", itemidpattern)[0] #only items starting with the part before the first placeholder can match
+		if prefix == itemidpattern: #no placeholders
+			item_id = normalize_path(itemidpattern)
+			return [SourceItem(self.source, item_id)] if self.source.index.exists(item_id) else []
+		regex = SourceItemList.compile_pattern(itemidpattern)
+		return [SourceItem(self.source, item_id) for item_id in self.source.index.get_item_ids(prefix) if regex.match(item_id)]
 
 class SourceItem(Loggable):
 	"""Represents an item in a source"""
 
+	__slots__ = ("source", "item_id", "log_id", "_generation", "_files", "_itemfile", "_contentfile", "_mtime", "_metadata")
+
 	def __init__(self, source, item_id):
 		self.source = source
 		self.item_id = item_id
 		self.log_id = self.source.source_id + "!" + item_id
+		self._generation = None #generation of the index the memoized values were computed for
+
+	def _update_generation(self):
+		"""forgets the memoized values, if files in the source changed since they were computed"""
+		generation = self.source.index.generation
+		if self._generation != generation:
+			self._generation = generation
+			self._files = self._itemfile = self._contentfile = self._mtime = UNKNOWN
+			self._metadata = None
 
 	def _get_all_filenames(self):
-		absolute_paths = glob.glob(self.source.get_absolute_path(self.item_id + ".*")) + glob.glob(self.source.get_absolute_path(self.item_id + "@*"))
-		local_paths = [self.source.get_local_path(abspath) for abspath in absolute_paths]
-		return [local_path for local_path in local_paths if re.match(extractor.RE_ITEMFILE, local_path)]
+		self._update_generation()
+		if self._files is UNKNOWN:
+			self._files = self.source.index.get_files(self.item_id)
+		return list(self._files)
 
 	def _get_itemfile(self):
-		item_filetypes = [ext for (ext,extr) in extractor.registered_extractors] #item file is the one exisiting first from this list
-		for filetype in item_filetypes:
-			filename = self.item_id + "." + filetype
-			if os.path.isfile(self.source.get_absolute_path(filename)):
-				return filename
-		return None #item does not exist
+		self._update_generation()
+		if self._itemfile is UNKNOWN:
+			self._itemfile = self.source.index.get_itemfile(self.item_id)
+		return self._itemfile
 
 	def _exists(self):
 		return not(self.itemfile == None)
 
 	def _get_contentfile(self):
-		content_filetypes = [".md", ".txt", ".png", ".jpg"] #item file is the one exisiting first from this list
-		for filetype in content_filetypes:
-			filename = self.item_id + filetype
-			if os.path.isfile(self.source.get_absolute_path(filename)):
-				return filename
-		return None #item does not exist
+		self._update_generation()
+		if self._contentfile is UNKNOWN:
+			self._contentfile = self.source.index.get_contentfile(self.item_id)
+		return self._contentfile
 
 	def _get_content_filenames(self):
 		contentfiles = self.files
@@ -546,10 +975,24 @@ class SourceItem(Loggable):
 		return contentfiles
 
 	def _get_mtime(self):
-		return max([os.path.getmtime(self.source.get_absolute_path(filename)) for filename in self.files])
+		self._update_generation()
+		if self._mtime is UNKNOWN:
+			self._mtime = self.source.index.get_mtime(self.item_id)
+		return self._mtime
 
 	def get_metadata(self, strict = False):
+		self._update_generation()
+		if self._metadata == None:
+			metadata, complete = self.extract_metadata(strict)
+			if not complete: #don't keep, so that warnings are shown again next time
+				return self.postprocess_metadata(metadata)
+			self._metadata = self.postprocess_metadata(metadata)
+		return copy.deepcopy(self._metadata)
+
+	def extract_metadata(self, strict = False):
+		"""extracts the metadata from the files of the item, returns the metadata and whether it is complete"""
 		metadata = {}
+		complete = True
 
 		#general metadata
 		metadata["last-modified"] = self.mtime
@@ -561,16 +1004,44 @@ class SourceItem(Loggable):
 				try:
 					metadata.update(extractor.extract_metadata(self.source.get_absolute_path(self.contentfile)))
 				except Exception, e:
+					complete = False
 					if not strict:
 						self.log_exception("No metadata extracted from file '" + self.contentfile + "'.", Logtype.WARNING)
 					else:
 						throw(ValueError, "No metadata extracted from file '" + self.contentfile + "'.", e)
 		#item file metadata
 		metadata.update(extractor.extract_metadata(self.source.get_absolute_path(self.itemfile)))
-		
-		metadata = self.postprocess_metadata(metadata)
 
-		return metadata
+		return metadata, complete
+
+	def get_references(self):
+		"""returns the absolute ids or id patterns of all items referenced in the metadata or in markdown files of the item"""
+		references = set()
+		try:
+			metadata, complete = self.extract_metadata(strict = True)
+		except Exception, e:
+			metadata = {} #reported by the integrity check
+		self._collect_references(metadata, references)
+
+		for srcfile in self.contentfiles:
+			if srcfile.rpartition(".")[2] in ["md", "txt"]:
+				try:
+					document = get_document(self.source.get_absolute_path(srcfile))
+					self._collect_references([reference for kind, reference, renderparams in document.get_references()], references)
+				except Exception, e:
+					pass #reported by the integrity check
+		return references
+
+	def _collect_references(self, metadata, references):
+		if isinstance(metadata, basestring):
+			if re.match(extractor.RE_ITEM_REFERENCE, metadata):
+				references.add(SourceItemList.absolute_itemid(metadata[1:], self))
+		elif isinstance(metadata, list):
+			for x in metadata:
+				self._collect_references(x, references)
+		elif isinstance(metadata, dict):
+			for v in metadata.values():
+				self._collect_references(v, references)
 
 	def postprocess_metadata(self, metadata):
 		if isinstance(metadata, basestring):
@@ -621,12 +1092,21 @@ class MetaChanged(IncrementalChange):
 		return "<MetaChanged " + sstr(self.item_id) + ">"
 
 class ItemChanged(IncrementalChange):
-	def __init__(self, source, item_id, filename):
+	def __init__(self, source, item_id, filenames):
 		super(ItemChanged, self).__init__(source,item_id)
-		self.filename = filename
-	
+		self.filenames = [filenames] if isinstance(filenames, basestring) else list(filenames)
+		self._item = None
+
+	def merge(self, change):
+		"""adds the changed files of a later change of the same item"""
+		for filename in change.filenames:
+			if not filename in self.filenames:
+				self.filenames.append(filename)
+
 	def _getitem(self):
-		return self.source.items[self.item_id]
+		if self._item == None: #the item keeps its values until files in the source change
+			self._item = self.source.items[self.item_id]
+		return self._item
 
 	def __str__(self):
 		return "<ItemChanged " + sstr(self.item_id) + ">"
@@ -5,12 +5,13 @@ from datetime import datetime
 from threading import Lock
 from inspect import isclass, getmembers
 
-from witica.util import Event, throw, AsyncWorker, sstr, get_cache_folder
+from witica.util import Event, throw, AsyncWorker, sstr, get_cache_folder, dropbox_content_hash, makedirs
 from witica.publish import Publish
-from witica.source import MetaChanged, ItemChanged, ItemRemoved
+from witica.source import MetaChanged, ItemChanged, ItemRemoved, SourceItem
 from witica import *
 from witica.log import *
 from witica.metadata import extractor
+from witica.references import ReferenceGraph
 
 
 cache_folder = get_cache_folder("Target")
@@ -51,6 +52,7 @@ class Target(AsyncWorker):
 	def __init__(self, site, target_id, config):
 		self.site = site
 		self.target_id = target_id
+		self.workers = config["workers"] if "workers" in config else 1
 		super(Target, self).__init__(site.source.source_id + "->" + target_id)
 
 		self.config = config
@@ -62,8 +64,7 @@ class Target(AsyncWorker):
 			self.log("Target is out of sync. Will fetch changes to get in sync with source again.", Logtype.WARNING)
 			changeEvent = Event()
 			changeEvent += self.enqueue_event
-			cursor = self.site.source.fetch_changes(changeEvent, self.state["source_cursor"])
-			self.save_source_cursor(self,cursor)
+			self.site.source.fetch_changes(changeEvent, self.state["source_cursor"], self.save_source_cursor)
 
 		#load publishing modules
 		for pubconfig in self.config["publishing"]:
@@ -82,58 +83,103 @@ class Target(AsyncWorker):
 		self.stoppedEvent += lambda sender, args: [p.close_queue() for p in self.publishing]
 
 	def init_cache(self):
-		self.state = {"version" : 1, "pendingChanges" : [], "source_cursor" : ""}
+		self.state = {"version" : 1, "source_cursor" : ""}
 		if os.path.isdir(self.get_target_dir()):
 			shutil.rmtree(self.get_target_dir())
 		os.makedirs(self.get_target_dir())
 
 	def load_state(self):
 		 try:
+			makedirs(cache_folder)
+			self.reference_graph = ReferenceGraph(self.references_filename)
 			if os.path.isfile(self.target_state_filename):
 				self.state = json.loads(open(self.target_state_filename).read())
 				if self.state["version"] != 1:
 					raise IOError("Version of state file " + self.target_state_filename + " is not compatible. Must be 1.")
-				
-				self.pending_events.clear()
-				for changeJSON in self.state["pendingChanges"]:
-					item_id = changeJSON["item_id"]
-					change = None
-					if changeJSON["type"] == "ItemChanged":
-						change = ItemChanged(self.site.source,item_id,changeJSON["filename"])
-					elif changeJSON["type"] == "ItemRemoved":
-						change = ItemRemoved(self.site.source,item_id)
-					elif changeJSON["type"] == "MetaChanged":
-						change = MetaChanged(self.site.source,item_id)
-					else:
-						self.log("Ignored unkown change type '" + changeJSON["type"] + "' in " + self.get_target_state_filename + ".", Logtype.WARNING)
-					
-					if change:
-						self.pending_events.append(change)
+
+				if "pendingChanges" in self.state: #migrate queue from state file, unless already moved to the journal
+					if not os.path.isfile(self.journal_filename):
+						self.pending_events.clear()
+						self.pending_events.extend([change for change in map(self.change_from_json, self.state["pendingChanges"]) if change])
+					del self.state["pendingChanges"]
 			else:
 				self.init_cache()
+				if os.path.isfile(self.journal_filename):
+					os.remove(self.journal_filename)
+				self.reference_graph.clear()
+			self.open_journal(self.journal_filename, self.change_to_json, self.change_from_json)
 		 except Exception as e:
 			throw(IOError, "Loading state file '" + self.target_state_filename + "' failed", e)
 
+	def change_to_json(self, change):
+		changeJSON = {"type": change.__class__.__name__, "item_id": change.item_id}
+		if change.__class__ == ItemChanged:
+			changeJSON["filenames"] = change.filenames
+		return changeJSON
+
+	def change_from_json(self, changeJSON):
+		item_id = changeJSON["item_id"]
+		if changeJSON["type"] == "ItemChanged":
+			return ItemChanged(self.site.source,item_id,changeJSON["filenames"] if "filenames" in changeJSON else changeJSON["filename"])
+		elif changeJSON["type"] == "ItemRemoved":
+			return ItemRemoved(self.site.source,item_id)
+		elif changeJSON["type"] == "MetaChanged":
+			return MetaChanged(self.site.source,item_id)
+		else:
+			self.log("Ignored unkown change type '" + changeJSON["type"] + "' in " + self.journal_filename + ".", Logtype.WARNING)
+			return None
+
 	def write_state(self):
 		self.writeStateLock.acquire()
-		self.state["version"] = 1
-		self.state["pendingChanges"] = []
-
-		toJSON = lambda change: dict({"type": change.__class__.__name__, "item_id": change.item_id}.items() + ({"filename": change.filename}.items() if change.__class__.__name__ == "ItemChanged" else []))
-		self.pending_events_lock.acquire()
 		try:
-			self.state["pendingChanges"] = map(toJSON, self.pending_events)
-		except Exception, e:
-			raise
-		finally:
-			self.pending_events_lock.release()
+			self.state["version"] = 1
+			s = json.dumps(self.state, indent=3)
 
-		s = json.dumps(self.state, indent=3)
-		
-		f = open(self.target_state_filename, 'w')
-		f.write(s + "\n")
-		f.close()
-		self.writeStateLock.release()
+			f = open(self.target_state_filename, 'w')
+			f.write(s + "\n")
+			f.close()
+		finally:
+			self.writeStateLock.release()
+
+	def enqueue_dependents(self, change):
+		"""updates the references of a changed item and enqueues the items referencing an added or removed item
+		called by process_event() after the item was converted, so that its markdown files were parsed already"""
+		dependents = set()
+		if change.__class__ == ItemChanged or change.__class__ == ItemRemoved:
+			item = SourceItem(self.site.source, change.item_id)
+			if change.__class__ == ItemChanged and item.exists:
+				if not self.reference_graph.contains(change.item_id): #added
+					dependents = self.reference_graph.get_dependents(change.item_id)
+				self.reference_graph.set_references(change.item_id, item.get_references())
+			elif self.reference_graph.contains(change.item_id): #removed
+				dependents = self.reference_graph.get_dependents(change.item_id)
+				self.reference_graph.remove(change.item_id)
+
+		for item_id in dependents:
+			dependent = SourceItem(self.site.source, item_id)
+			if dependent.exists:
+				self.log("Item '" + sstr(item_id) + "' is rebuilt, because it references '" + sstr(change.item_id) + "'.", Logtype.DEBUG)
+				self.add_event(ItemChanged(self.site.source, item_id, dependent.files)) #also if the queue was closed meanwhile
+
+	def get_event_key(self, change):
+		if change.__class__ == MetaChanged:
+			return ("meta", change.item_id)
+		else:
+			return ("item", change.item_id)
+
+	def merge_events(self, pending, change):
+		if change.__class__ == MetaChanged: #already pending
+			return pending
+		elif change.__class__ == ItemRemoved: #earlier changes of the item don't need to be processed anymore
+			return change
+		elif change.__class__ == ItemChanged and pending.__class__ == ItemChanged:
+			pending.merge(change)
+			return pending
+		else: #item was removed and created again
+			return None
+
+	def is_barrier(self, change):
+		return change.__class__ == MetaChanged #site metadata can affect all items
 
 	def save_source_cursor(self, sender, cursor):
 		self.state["source_cursor"] = cursor
@@ -144,8 +190,9 @@ class Target(AsyncWorker):
 		[p.stop() for p in self.publishing]
 
 	def publish(self,filename):	
+		content_hash = dropbox_content_hash(self.get_absolute_path(filename)) #publishing modules skip files they already published
 		for p in self.publishing:
-			p.publish_file(self.get_absolute_path(filename), self.target_id + "/" + filename)
+			p.publish_file(self.get_absolute_path(filename), self.target_id + "/" + filename, content_hash)
 
 	def unpublish(self,filename):
 		for p in self.publishing:
@@ -158,8 +205,9 @@ class Target(AsyncWorker):
 				self.log_exception("File '" + filename + "' in target cache could not be removed.", Logtype.WARNING)
 
 	def publish_meta(self,filename):	
+		content_hash = dropbox_content_hash(self.get_abs_meta_filename(filename))
 		for p in self.publishing:
-			p.publish_file(self.get_abs_meta_filename(filename), filename)
+			p.publish_file(self.get_abs_meta_filename(filename), filename, content_hash)
 
 	def unpublish_meta(self,filename):
 		for p in self.publishing:
@@ -174,6 +222,12 @@ class Target(AsyncWorker):
 	def get_target_state_filename(self):
 		return cache_folder + os.sep + self.site.source.source_id + "." + self.target_id + ".target"
 
+	def get_journal_filename(self):
+		return cache_folder + os.sep + self.site.source.source_id + "." + self.target_id + ".journal"
+
+	def get_references_filename(self):
+		return cache_folder + os.sep + self.site.source.source_id + "." + self.target_id + ".references"
+
 	def get_target_dir(self):
 		return cache_folder + os.sep + self.site.source.source_id + "." + self.target_id
 
@@ -194,4 +248,6 @@ class Target(AsyncWorker):
 		return self.site.source.resolve_reference(reference,item,allow_patterns)
 
 	target_state_filename = property(get_target_state_filename)
+	journal_filename = property(get_journal_filename)
+	references_filename = property(get_references_filename)
 	target_dir = property(get_target_dir)
@@ -1,6 +1,6 @@
 # coding=utf-8
 
-import os, tempfile, shutil, time, codecs, json
+import os, tempfile, shutil, time, codecs, json, threading
 import unittest
 import pkg_resources
 
@@ -8,8 +8,12 @@ from PIL import Image
 
 from witica.log import Logger
 from witica.site import Site
-from witica.source import Source, ItemChanged
+from witica.source import Source, ItemChanged, ItemRemoved, MetaChanged
 from witica.targets.web import WebTarget
+from witica.targets import web
+from witica.cache import ConversionCache
+from witica.targets import target
+from witica import publish
 from witica.metadata.extractor import MDExtractor, ImageExtractor
 from witica.metadata import extractor
 from witica.test_source import FolderSource
@@ -27,6 +31,12 @@ class TestWebTarget(unittest.TestCase):
 
 		self.target_path = tempfile.mkdtemp()
 		self.publish_path = os.path.join(self.target_path, "TestWebTarget")
+		self.original_cache_folder = target.cache_folder
+		target.cache_folder = publish.cache_folder = os.path.join(self.target_path, "Cache") #doesn't exist yet
+		self.original_get_conversion_cache = web.get_conversion_cache
+		conversion_cache = ConversionCache(os.path.join(self.target_path, "Conversion"), 10**9) #images are converted in every test
+		web.get_conversion_cache = lambda: conversion_cache
+		web.start_image_pool()
 		target_config = {
 			"version": 1,
 			"type": "WebTarget",
@@ -45,11 +55,16 @@ class TestWebTarget(unittest.TestCase):
 		extractor.register_default_extractors()
 
 	def tearDown(self):
-		extractor.registered_extractors = []
+		extractor.unregister_all()
 		pkg_resources.cleanup_resources()
-		shutil.rmtree(self.target_path)
 		if self.site.source:
 			self.site.source.stoppedEvent(self.site.source, None)
+		[thread.join() for thread in self.target.worker_threads] #closes the publishing queues when stopped
+		[thread.join() for p in self.target.publishing for thread in p.worker_threads]
+		web.stop_image_pool()
+		target.cache_folder = publish.cache_folder = self.original_cache_folder
+		web.get_conversion_cache = self.original_get_conversion_cache
+		shutil.rmtree(self.target_path)
 		Logger.stop()
 
 	def convert_file(self, filename):
@@ -73,6 +88,69 @@ class TestWebTarget(unittest.TestCase):
 		result = open(os.path.join(self.publish_path, "empty_title.html")).read()
 		self.assertEqual(result, "<h1></h1>\n<p>This is a test markdown file without json part.</p>")
 
+	def test_skip_unchanged(self):
+		self.convert_file("simple.md")
+		os.remove(os.path.join(self.publish_path, "simple.html"))
+		self.convert_file("simple.md")
+		self.assertFalse(os.path.exists(os.path.join(self.publish_path, "simple.html"))) #output didn't change, not published again
+
+		self.target.publishing[0].manifest.clear()
+		self.convert_file("simple.md")
+		self.assertTrue(os.path.exists(os.path.join(self.publish_path, "simple.html")))
+
+	def test_skip_unchanged_variants(self):
+		self.convert_file("photo.jpg")
+		os.remove(os.path.join(self.publish_path, "photo@512.jpg"))
+		self.convert_file("photo.jpg")
+		self.assertFalse(os.path.exists(os.path.join(self.publish_path, "photo@512.jpg"))) #neither deleted nor published again
+		self.assertTrue(os.path.exists(self.target.get_absolute_path("photo@512.jpg")))
+
+	def test_target_hash(self):
+		self.convert_file("simple.md")
+		self.convert_file("links.md")
+		self.target.update_target_hash() #the queue may have drained before the hash was updated
+		target_hash = open(self.target.get_absolute_path("TARGET_HASH")).read()
+		self.convert_file("simple.md")
+		self.target.update_target_hash()
+		self.assertEqual(open(self.target.get_absolute_path("TARGET_HASH")).read(), target_hash) #nothing changed
+
+		self.target.set_item_hash("folder/simple", "0123")
+		self.target.update_target_hash()
+		self.assertNotEqual(open(self.target.get_absolute_path("TARGET_HASH")).read(), target_hash)
+		self.assertTrue(os.path.isfile(self.target.get_absolute_path("folder/DIRECTORY_HASH")))
+
+		self.target.set_item_hash("folder/simple", None)
+		self.target.update_target_hash()
+		self.assertEqual(open(self.target.get_absolute_path("TARGET_HASH")).read(), target_hash)
+		self.assertFalse(os.path.isfile(self.target.get_absolute_path("folder/DIRECTORY_HASH")))
+
+	def test_target_hash_on_close(self):
+		update_target_hash = self.target.update_target_hash
+		def slow_update_target_hash():
+			time.sleep(0.2)
+			update_target_hash()
+		self.target.update_target_hash = slow_update_target_hash
+		self.target.call_in_worker = lambda function: function() #complete in the thread of the image pool instead
+		self.target.enqueue_event(self.site.source, ItemChanged(self.site.source, "photo", "photo.jpg"))
+		self.target.close_queue()
+		self.target.worker_thread.join()
+		[thread.join() for thread in self.target.publishing[0].worker_threads]
+		self.assertTrue(os.path.isfile(os.path.join(self.publish_path, "TARGET_HASH"))) #published before the publishing queue was closed
+
+	def test_enqueue_in_queue_empty(self):
+		enqueued = []
+		def update_target_hash():
+			if len(enqueued) == 0:
+				thread = threading.Thread(target=self.target.enqueue_event, args=(self.site.source, ItemChanged(self.site.source, "links", "links.md")))
+				thread.start()
+				thread.join(5) #the queue isn't locked while the hook is running
+				enqueued.append(not thread.isAlive())
+		self.target.update_target_hash = update_target_hash
+		self.convert_file("simple.md")
+		self.assertEqual([True], enqueued)
+		self.convert_file("simple.md")
+		self.assertTrue(os.path.isfile(os.path.join(self.publish_path, "links.html")))
+
 	def test_photo(self):
 		self.convert_file("photo.jpg")
 		self.assertTrue(os.path.exists(os.path.join(self.publish_path, "photo.jpg")))
@@ -94,6 +172,28 @@ class TestWebTarget(unittest.TestCase):
 		self.assertEqual(max(img.size), 1024)
 		img.close()
 
+	def test_photo_completed_on_worker(self):
+		threads = []
+		finish_event = self.target.finish_event
+		def record_thread(*args):
+			threads.append(threading.current_thread())
+			finish_event(*args)
+		self.target.finish_event = record_thread
+		self.convert_file("photo.jpg")
+		self.assertEqual(1, len(threads))
+		self.assertIn(threads[0], self.target.worker_threads) #not on the result thread of the image pool
+
+	def test_image_pool_timeout(self):
+		pool = web.ImagePool(timeout = 0.2)
+		results = []
+		completed = threading.Event()
+		pool.apply_async(time.sleep, (5,), lambda result: (results.append(result), completed.set()))
+		completed.wait(5)
+		pool.close() #terminates the process that is still sleeping
+		self.assertEqual(1, len(results))
+		self.assertEqual(None, results[0][0])
+		self.assertIn("didn't finish", results[0][1])
+
 	def test_links(self):
 		self.convert_file("links.md")
 		result = open(os.path.join(self.publish_path, "links.html")).readlines()
@@ -101,3 +201,79 @@ class TestWebTarget(unittest.TestCase):
 		#self.assertTrue('<a href="#!öäüß¡““¢≠}{|¢¶“∞…–∞œäö()">öäüß¡““¢≠}{|¢¶“∞…–∞œäö()</a>"' in result[1])
 		self.assertTrue('<a href="#!simple">relative</a>' in result[2])
 
+
+	def test_coalesce_changes(self):
+		self.target.stop() #stop processing, so that the events stay in the queue
+		self.target.worker_thread.join()
+		source = self.site.source
+		try:
+			self.target.enqueue_event(source, ItemChanged(source, "simple", "simple.md"))
+			self.target.enqueue_event(source, ItemChanged(source, "links", "links.md"))
+			self.target.enqueue_event(source, MetaChanged(source, "web.target"))
+			self.target.enqueue_event(source, ItemChanged(source, "simple", "simple.item"))
+			self.target.enqueue_event(source, ItemChanged(source, "simple", "simple.md"))
+			self.target.enqueue_event(source, MetaChanged(source, "web.target"))
+			self.target.enqueue_event(source, ItemRemoved(source, "links"))
+			#changes are not merged into events before a barrier
+			self.assertEqual(["<ItemChanged simple>", "<ItemChanged links>", "<MetaChanged web.target>", "<ItemChanged simple>", "<ItemRemoved links>"], [str(e) for e in self.target.pending_events])
+			self.assertEqual(["simple.md"], self.target.pending_events[0].filenames)
+			self.assertEqual(["simple.item", "simple.md"], self.target.pending_events[3].filenames)
+
+			#queue can be restored from the journal, even if the last record is incomplete
+			open(self.target.journal_filename, "a").write('{"op": "ack"')
+			restored = self.target.journal.replay()
+			self.assertEqual([str(e) for e in self.target.pending_events], [str(e) for e in restored])
+			self.assertEqual(["simple.item", "simple.md"], restored[3].filenames)
+		finally:
+			self.target.pending_events.clear()
+			self.target.pending_keys.clear()
+			self.target.journal.compact(self.target.pending_events)
+
+	def test_enqueue_dependents(self):
+		self.target.stop() #stop processing, so that the events stay in the queue
+		self.target.worker_thread.join()
+		source = self.site.source
+		try:
+			self.target.enqueue_dependents(ItemChanged(source, "simple", "simple.md"))
+			self.target.enqueue_dependents(ItemChanged(source, "links", "links.md"))
+			self.assertEqual(set(["links"]), self.target.reference_graph.get_dependents("simple"))
+			self.assertEqual(0, len(self.target.pending_events))
+
+			self.target.enqueue_dependents(ItemRemoved(source, "simple"))
+			self.assertEqual(["<ItemChanged links>"], [str(e) for e in self.target.pending_events])
+			self.target.enqueue_dependents(ItemChanged(source, "simple", "simple.md")) #added again
+			self.assertEqual(["<ItemChanged links>"], [str(e) for e in self.target.pending_events]) #merged
+		finally:
+			self.target.pending_events.clear()
+			self.target.pending_keys.clear()
+			self.target.journal.compact(self.target.pending_events)
+
+	def test_schedule_changes(self):
+		self.target.stop() #stop processing, the scheduling is tested without running the workers
+		self.target.worker_thread.join()
+		self.target.workers = 3
+		source = self.site.source
+		try:
+			self.target.enqueue_event(source, ItemChanged(source, "simple", "simple.md"))
+			self.target.enqueue_event(source, ItemChanged(source, "links", "links.md"))
+			self.target.enqueue_event(source, MetaChanged(source, "web.target"))
+			self.target.enqueue_event(source, ItemChanged(source, "empty_title", "empty_title.md"))
+			self.target.processing.append(self.target.next_event())
+			self.target.enqueue_event(source, ItemChanged(source, "simple", "simple.item")) #not merged into the change being processed
+			self.assertEqual(5, len(self.target.pending_events))
+
+			self.assertEqual("<ItemChanged links>", str(self.target.next_event())) #other items are processed concurrently
+			self.target.processing.append(self.target.next_event())
+			self.assertEqual(None, self.target.next_event()) #meta change waits for all changes before it
+
+			self.target.processing = []
+			self.target.pending_events.popleft()
+			self.target.pending_events.popleft()
+			self.assertEqual("<MetaChanged web.target>", str(self.target.next_event()))
+			self.target.processing.append(self.target.next_event())
+			self.assertEqual(None, self.target.next_event()) #changes after the meta change wait for it
+		finally:
+			self.target.processing = []
+			self.target.pending_events.clear()
+			self.target.pending_keys.clear()
+			self.target.journal.compact(self.target.pending_events)
@@ -1,26 +1,33 @@
-import os, json, shutil, time, codecs, hashlib, glob, re
+import os, json, shutil, time, codecs, hashlib, glob, re, signal
+import multiprocessing
 from datetime import datetime
+from threading import Lock, Condition, Thread
 
 import markdown
-from markdown.treeprocessors import Treeprocessor
-from markdown.inlinepatterns import LinkPattern, ImagePattern
-from markdown.extensions import Extension
+import PIL
 from PIL import Image, ImageFile
 
 
 from witica import *
-from witica.util import throw, sstr, get_cache_folder
+from witica.util import throw, sstr, get_cache_folder, Deferred
 from witica.source import MetaChanged, ItemChanged, ItemRemoved
 from witica.log import *
 from witica.metadata import extractor
+from witica.metadata.document import get_document
 from witica.targets.target import Target
 from witica.check import IntegrityChecker, Severity
+from witica.cache import get_conversion_cache
 
 
 cache_folder = get_cache_folder("Target")
 
 class WebTarget(Target):
 	def __init__(self, site, target_id, config):
+		self.target_hash_lock = Lock()
+		self.hash_tree = None #directory -> {item name or subdirectory name + "/" -> hash}, loaded on first use
+		self.directory_hashes = {} #directory -> last published hash, "" is the TARGET_HASH
+		self.dirty_directories = set()
+		self.hashes_verified = False #True after the hashes loaded from the target cache were published once
 		Target.__init__(self,site,target_id, config)
 
 		self.imgconfig = { #default image config
@@ -61,47 +68,129 @@ class WebTarget(Target):
 				else:
 					self.unpublish_meta(filename)
 		elif change.__class__ == ItemChanged:
-			if not(change.item.exists):
+			item = change.item #the metadata is read once and shared by the integrity check and publish_metadata
+			if not(item.exists):
+				self.enqueue_dependents(change)
 				return
-			#self.log("id: " + change.item_id + ", \nall files: " + sstr(change.item.files) + ", \nitem file: " + sstr(change.item.itemfile) + ", \nmain content: " + sstr(change.item.contentfile) + ", \ncontentfiles: " + sstr(change.item.contentfiles), Logtype.WARNING)
+			#self.log("id: " + change.item_id + ", \nall files: " + sstr(item.files) + ", \nitem file: " + sstr(item.itemfile) + ", \nmain content: " + sstr(item.contentfile) + ", \ncontentfiles: " + sstr(item.contentfiles), Logtype.WARNING)
 			#check integrity of the item
 			ic = IntegrityChecker(self.site.source)
-			faults = ic.check(change.item)
+			faults = ic.check(item)
 
 			for fault in faults:
 				if fault.severity == Severity.FATAL:
-					raise ValueError("Integrity check of item '" + sstr(change.item.item_id) + "' detected fatal fault:\n" + sstr(fault))
+					raise ValueError("Integrity check of item '" + sstr(item.item_id) + "' detected fatal fault:\n" + sstr(fault))
 				else:
 					self.log(sstr(fault), Logtype.WARNING)
 
 			#make sure the target cache directory exists
-			filename = self.get_absolute_path(change.item.item_id + ".item")
-			if not os.path.exists(os.path.split(filename)[0]):
-				os.makedirs(os.path.split(filename)[0])
+			filename = self.get_absolute_path(item.item_id + ".item")
+			util.makedirs(os.path.split(filename)[0])
 
 			#convert and publish content and metadata
-			if change.filename in change.item.contentfiles:
-				self.publish_contentfile(change.item,change.filename)
-			else:
-				self.unpublish_contentfile(change.item,change.filename)
-
-			self.publish_metadata(change.item)
+			contentfiles = item.contentfiles
+			conversions = []
+			for filename in change.filenames:
+				if filename in contentfiles:
+					conversion = self.publish_contentfile(item,filename)
+					if conversion:
+						conversions.append(conversion)
+				elif filename != item.itemfile: #item file is published with the metadata
+					self.unpublish_contentfile(item,filename)
+			self.enqueue_dependents(change)
+
+			if len(conversions) > 0: #metadata lists the converted files, so it is published when the conversions are finished
+				return Deferred.gather(conversions).then(lambda results: self.publish_metadata(item))
+			self.publish_metadata(item)
 		elif change.__class__ == ItemRemoved:
 			#remove all files from server and target cache
 			files = self.get_content_files(change.item_id)
 			files.append(change.item_id + ".item")
+			files.append(change.item_id + ".itemhash")
 			for filename in files:
 				self.unpublish(filename)
 			#TODO: check if dir is empty and delete if so
+			self.set_item_hash(change.item_id, None)
+			self.enqueue_dependents(change)
 
-		#update HASH file
+	def queue_empty(self):
 		self.update_target_hash()
 
+	def set_item_hash(self, item_id, item_hash):
+		"""records the hash of an item (None if removed), the directory hashes are updated with the next update_target_hash()"""
+		with self.target_hash_lock:
+			if self.hash_tree == None:
+				self.load_hashes()
+			directory, sep, name = item_id.rpartition("/")
+			entries = self.hash_tree.setdefault(directory, {})
+			if item_hash:
+				entries[name] = item_hash
+			else:
+				entries.pop(name, None)
+			self.dirty_directories.add(directory)
+
+	def load_hashes(self):
+		"""builds the hash tree from the item hash and directory hash files in the target cache, must be called while holding the target_hash_lock"""
+		self.hash_tree = {"": {}}
+		self.directory_hashes = {}
+		self.dirty_directories = set([""]) #compare all directories with the published hashes on the next update
+		self.hashes_verified = False
+		for root, dirs, files in os.walk(self.get_absolute_path("")):
+			directory = self.get_local_path(root).replace(os.sep, "/") if root != self.get_absolute_path("") else ""
+			if directory == "":
+				dirs[:] = [d for d in dirs if d != "meta"] #files from the target meta dir are no items
+			for filename in files:
+				if filename.endswith(".itemhash"):
+					item_hash = open(os.path.join(root, filename)).read().strip()
+					self.hash_tree.setdefault(directory, {})[filename.rpartition(".itemhash")[0]] = item_hash
+					self.dirty_directories.add(directory)
+				elif filename == "DIRECTORY_HASH" or (directory == "" and filename == "TARGET_HASH"):
+					self.directory_hashes[directory] = open(os.path.join(root, filename)).read().strip()
+					self.dirty_directories.add(directory)
+
+	def get_directory_hash_filename(self, directory):
+		return directory + "/DIRECTORY_HASH" if directory else "TARGET_HASH"
+
 	def update_target_hash(self):
-		hash_str = sstr(hashlib.md5(datetime.now().strftime("%s")).hexdigest())
-		hash_file = codecs.open(self.get_absolute_path("TARGET_HASH"), "w", encoding="utf-8", errors="xmlcharrefreplace")
-		hash_file.write(hash_str)
-		self.publish("TARGET_HASH")
+		"""recomputes the hashes of all directories containing changed items bottom up and publishes the changed ones
+		the hash of a directory is computed from the hashes of the items and subdirectories in it, the hash of the root is the TARGET_HASH"""
+		with self.target_hash_lock: #events are processed by several workers
+			if self.hash_tree == None:
+				self.load_hashes()
+			while len(self.dirty_directories) > 0:
+				directory = max(self.dirty_directories, key=lambda d: d.count("/") + (1 if d else 0)) #deepest first
+				self.dirty_directories.remove(directory)
+				entries = self.hash_tree.get(directory, {})
+				if len(entries) == 0 and directory != "":
+					self.hash_tree.pop(directory, None)
+					dir_hash = None
+				else:
+					hash_input = u"\n".join([name + u" " + entries[name] for name in sorted(entries)])
+					dir_hash = sstr(hashlib.md5(hash_input.encode("utf-8")).hexdigest())
+
+				if dir_hash == self.directory_hashes.get(directory) and (dir_hash == None or self.hashes_verified):
+					continue
+				filename = self.get_directory_hash_filename(directory)
+				if dir_hash:
+					self.directory_hashes[directory] = dir_hash
+					util.makedirs(os.path.split(self.get_absolute_path(filename))[0])
+					hash_file = codecs.open(self.get_absolute_path(filename), "w", encoding="utf-8")
+					hash_file.write(dir_hash)
+					hash_file.close()
+					self.publish(filename)
+				else:
+					del self.directory_hashes[directory]
+					self.unpublish(filename)
+
+				if directory != "": #update hash of the parent directory
+					parent, sep, name = directory.rpartition("/")
+					parent_entries = self.hash_tree.setdefault(parent, {})
+					if dir_hash:
+						parent_entries[name + "/"] = dir_hash
+					else:
+						parent_entries.pop(name + "/", None)
+					self.dirty_directories.add(parent)
+			self.hashes_verified = True #publishing modules skip hashes that were already published
 
 	def get_content_files(self,item_id):
 		absolute_paths = glob.glob(self.get_absolute_path(item_id + ".*")) + glob.glob(self.get_absolute_path(item_id + "@*"))
@@ -147,6 +236,7 @@ class WebTarget(Target):
 		hf.write(itemhashstr + "\n")
 		hf.close()
 		self.publish(item.item_id + ".itemhash")
+		self.set_item_hash(item.item_id, itemhashstr)
 
 	def publish_contentfile(self,item,srcfile):
 		filename = srcfile.rpartition(".")[0]
@@ -158,10 +248,14 @@ class WebTarget(Target):
 		elif filetype == "jpg" or filetype == "jpeg":
 			re_image_files = re.compile('^' + item.item_id + '@[\s\S]*.(jpg|jpeg)$')
 			old_image_files = [filename for filename in self.get_content_files(item.item_id) if re_image_files.match(filename)]
-			for filename in old_image_files:
-				self.unpublish(filename)
 
-			[self.publish(dstfile) for dstfile in self.convert_image(srcfile, item)]
+			def publish_variants(dstfiles):
+				for filename in old_image_files:
+					if not filename in dstfiles: #variant isn't generated anymore, unchanged variants are not uploaded again
+						self.unpublish(filename)
+				for dstfile in dstfiles:
+					self.publish(dstfile)
+			return self.convert_image(srcfile, item).then(publish_variants)
 		else:
 			dstfile = srcfile #keep filename
 			util.copyfile(self.site.source.get_absolute_path(srcfile), self.get_absolute_path(dstfile))
@@ -186,28 +280,28 @@ class WebTarget(Target):
 			self.unpublish(dstfile)
 
 	def convert_md2html(self,srcfile,dstfile,item):
-		input_file = codecs.open(self.site.source.get_absolute_path(srcfile), mode="r", encoding="utf-8")
-		text = input_file.read()
-		html = ""
+		cache = get_conversion_cache()
+		key = cache.make_key("WebTarget.md2html", 1, markdown.version, self.site.source.index.get_content_hash(srcfile))
+		references = ReferenceRecorder(self)
+		if cache.restore(key, {"html": self.get_absolute_path(dstfile)}, lambda info: references.check(info["references"], item)):
+			return
 
 		try:
-			#split json and markdown parts
-			jsonstr, mdstring = re.match(extractor.RE_MD_SPLIT_JSON_MD,text).groups()
-			#split title and body part
-			title, mdbody = re.match(extractor.RE_MD_SPLIT_TITLE_BODY,mdstring).groups()
-			link_ext = LinkExtension(self,item)
-			inline_item_ext = InlineItemExtension(self, item)
-			html = markdown.markdown(mdbody, extensions = [link_ext, inline_item_ext])
+			html = get_document(self.site.source.get_absolute_path(srcfile)).get_html(
+				lambda kind, reference: ("#!" if kind == "link" else "") + references.resolve_reference(reference, item))
 		except Exception, e:
 			throw(IOError,"Markdown file '" + sstr(srcfile) + "' has invalid syntax.", e)
 
 		output_file = codecs.open(self.get_absolute_path(dstfile), "w", encoding="utf-8", errors="xmlcharrefreplace")
 		output_file.write(html)
+		output_file.close()
+		cache.store(key, {"html": self.get_absolute_path(dstfile)}, {"references": references.references})
 
 	def convert_image(self, srcfile, item):
+		"""generates the image variants in the image process pool, returns a Deferred for the list of generated files"""
 		filename, sep, extension = srcfile.rpartition(".")
 		dstfiles = []
-		img = Image.open(self.site.source.get_absolute_path(srcfile))
+		img = Image.open(self.site.source.get_absolute_path(srcfile)) #only reads the header
 
 		keep_original = False
 		sizes = [variant["size"] for variant in self.imgconfig["variants"]]
@@ -218,72 +312,158 @@ class WebTarget(Target):
 
 		max_size = max([size for size in sizes if size <= max(img.size)])
 
+		variants = []
 		for variant in self.imgconfig["variants"]:
-			ImageFile.MAXBLOCK = 2**22
-			img = Image.open(self.site.source.get_absolute_path(srcfile))
 			if variant["size"] <= max(img.size):
 				dstfile = filename + "@" + sstr(variant["size"]) + sep +  extension
 				if not(keep_original) and variant["size"] == max_size:
 					dstfile = srcfile #save biggest variant with original filename
-				img.thumbnail((variant["size"],variant["size"]), Image.ANTIALIAS)
-				progressive = False
-				if variant["progressive"] == "yes":
-					progressive = True
-				img.save(self.get_absolute_path(dstfile), "JPEG", quality=int(100*variant["quality"]), optimize=True, progressive=progressive)
+				variants.append((self.get_absolute_path(dstfile), variant["size"], int(100*variant["quality"]), variant["progressive"] == "yes"))
 				dstfiles.append(dstfile)
 
-		return dstfiles
-
-
-#markdown extensions
-class ItemPattern(LinkPattern):
-	""" Return a view element from the given match. """
-	def __init__(self, pattern, md, target, item):
-		LinkPattern.__init__(self, pattern, md)
-		self.target = target
-		self.item = item
-
-	def handleMatch(self, m):
-		el = markdown.util.etree.Element("view")
-		item_id = m.group(3)
-		if re.match(extractor.RE_ITEM_REFERENCE, item_id):
-			item_id = self.target.resolve_reference(item_id,self.item)
-
-		el.set('item', item_id)
-		if not m.group(2) == None:
-			renderparam = markdown.util.etree.Comment(m.group(2))
-			el.append(renderparam)
-		return el
-
-class InlineItemExtension(Extension):
-	""" add inline views to markdown """
-	def __init__(self, target, item):
-		self.target = target
-		self.item = item
-
-	def extendMarkdown(self, md, md_globals):
-		""" Override existing Processors. """
-		md.inlinePatterns['image_link'] = ImagePattern(extractor.RE_MD_IMAGE_LINK, md)
-		md.inlinePatterns.add('item_link', ItemPattern(extractor.RE_MD_ITEM_LINK, md, self.target, self.item),'>image_link')
-
-class LinkExtension(Extension):
-	def __init__(self, target, item):
-		self.target = target
-		self.item = item
-
-	def extendMarkdown(self, md, md_globals):
-		# Insert instance of 'mypattern' before 'references' pattern
-		md.treeprocessors.add("link", LinkTreeprocessor(self.target, self.item), "_end")
-
-class LinkTreeprocessor(Treeprocessor):
-	def __init__(self, target, item):
+		deferred = Deferred()
+		cache = get_conversion_cache()
+		key = cache.make_key("WebTarget.image", 1, PIL.__version__, self.site.source.index.get_content_hash(srcfile), [variant[1:] for variant in variants])
+		destinations = dict([(sstr(variant[1]), variant[0]) for variant in variants])
+		if cache.restore(key, destinations):
+			deferred.resolve(dstfiles)
+			return deferred
+
+		def completed(result):
+			error = result[1]
+			if error:
+				deferred.fail(IOError("Converting image '" + sstr(srcfile) + "' failed: " + error))
+			else:
+				cache.store(key, destinations)
+				deferred.resolve(dstfiles)
+		get_image_pool().apply_async(convert_image_variants, (self.site.source.get_absolute_path(srcfile), variants), lambda result: self.call_in_worker(lambda: completed(result)))
+		return deferred
+
+IMAGE_TIMEOUT = 300 #seconds a conversion may take before it fails, i.e. because its pool process died
+
+class ImagePool(Loggable):
+	"""Process pool for converting images, fails conversions that didn't finish within timeout seconds
+
+	A pool process that dies loses its task without a result, so a watcher thread waits for the results instead of the
+	result thread of the multiprocessing pool, which would wait forever."""
+
+	def __init__(self, timeout = IMAGE_TIMEOUT):
+		self.log_id = "ImagePool"
+		self.timeout = timeout
+		self.pool = multiprocessing.Pool(initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN)) #main process handles ctrl+c
+		self._pending = [] #(result, deadline, callback) in the order of the deadlines
+		self._lock = Lock()
+		self._changed = Condition(self._lock)
+		self._closed = False
+		self._abandoned = False #True if a pool process might still be busy with a failed task
+		self.watcher_thread = Thread(target=self.watch, name="Image pool watcher")
+		self.watcher_thread.daemon = True
+		self.watcher_thread.start()
+
+	def apply_async(self, function, args, callback):
+		"""runs function(*args) in a pool process, callback is called on the watcher thread with the result
+		or with (None, error message) if the conversion failed or timed out"""
+		with self._lock:
+			if self._closed:
+				raise IOError("The image pool was closed.")
+			self._pending.append((self.pool.apply_async(function, args), time.time() + self.timeout, callback))
+			self._changed.notify()
+
+	def watch(self):
+		while True:
+			with self._lock:
+				while len(self._pending) == 0 and not self._closed:
+					self._changed.wait()
+				if len(self._pending) == 0:
+					return
+				result, deadline, callback = self._pending[0]
+				closed = self._closed
+			if not closed:
+				result.wait(max(0, min(deadline - time.time(), 1))) #check regularly if the pool was closed
+			if result.ready():
+				try:
+					value = result.get()
+				except Exception, e:
+					value = (None, e.__class__.__name__ + ": " + sstr(e))
+			elif closed:
+				value = (None, "The image pool was closed.")
+				self._abandoned = True
+			elif time.time() >= deadline:
+				value = (None, "Conversion didn't finish within " + sstr(self.timeout) + " seconds.")
+				self._abandoned = True
+			else:
+				continue
+			with self._lock:
+				self._pending.pop(0)
+			try:
+				callback(value)
+			except Exception, e:
+				self.log_exception("Completing a conversion failed.", Logtype.ERROR)
+
+	def close(self):
+		"""stops the pool processes, conversions that didn't finish yet fail"""
+		with self._lock:
+			self._closed = True
+			self._changed.notify()
+		self.watcher_thread.join()
+		self.pool.close()
+		if self._abandoned:
+			self.pool.terminate()
+		self.pool.join()
+
+image_pool = None
+
+def start_image_pool():
+	"""starts the process pool shared by all web targets, should be called before other threads are started"""
+	global image_pool
+	if image_pool == None:
+		image_pool = ImagePool()
+
+def stop_image_pool():
+	global image_pool
+	if image_pool != None:
+		image_pool.close()
+		image_pool = None
+
+def get_image_pool():
+	"""returns the process pool shared by all web targets for converting images"""
+	if image_pool == None:
+		raise IOError("The image pool was not started.")
+	return image_pool
+
+def convert_image_variants(srcpath, variants):
+	"""saves the variants (destination path, size, quality, progressive) of an image, runs in the image process pool
+	returns the destination paths and an error message or None"""
+	try:
+		ImageFile.MAXBLOCK = 2**22
+		variants = sorted(variants, key=lambda variant: variant[1], reverse=True) #each variant is scaled down from the previous one
+		img = Image.open(srcpath)
+		if len(variants) > 0:
+			img.draft(img.mode, (variants[0][1], variants[0][1])) #let the jpeg decoder scale down to the biggest variant
+		img.load() #decode only once
+		for dstpath, size, quality, progressive in variants:
+			img.thumbnail((size,size), Image.ANTIALIAS)
+			img.save(dstpath, "JPEG", quality=quality, optimize=True, progressive=progressive)
+		return [variant[0] for variant in variants], None
+	except Exception, e:
+		return None, e.__class__.__name__ + ": " + sstr(e)
+
+
+class ReferenceRecorder(object):
+	"""Resolves references in converted files and records the resolutions a converted file depends on"""
+
+	def __init__(self, target):
 		self.target = target
-		self.item = item
-
-	def run(self, root):
-		for a in root.findall(".//a"):
-			item_id = a.get("href")
-			if re.match(extractor.RE_ITEM_REFERENCE, item_id):
-				item_id = self.target.resolve_reference(item_id,self.item)
-				a.set("href", "#!" + item_id) #TODO: better write correct a tag in the first place instead of fixing here afterwards
-		return root
\ No newline at end of file
+		self.references = [] #[reference, allow_patterns, resolved reference]
+
+	def resolve_reference(self, reference, item, allow_patterns = False):
+		resolved = self.target.resolve_reference(reference, item, allow_patterns)
+		self.references.append([reference, allow_patterns, resolved])
+		return resolved
+
+	def check(self, references, item):
+		"""returns True if all recorded references still resolve the same way for item"""
+		for reference, allow_patterns, resolved in references:
+			if self.target.resolve_reference(reference, item, allow_patterns) != resolved:
+				return False
+		return True
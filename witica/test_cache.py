@@ -0,0 +1,93 @@
+# coding=utf-8
+
+import os, tempfile, shutil, time
+import unittest
+
+from witica.log import *
+from witica.cache import ConversionCache, MetadataCache
+
+
+class TestConversionCache(unittest.TestCase):
+	def setUp(self):
+		Logger.start(verbose=False)
+		self.path = tempfile.mkdtemp()
+		self.cache = ConversionCache(os.path.join(self.path, "Conversion"), 1000)
+
+	def tearDown(self):
+		Logger.stop()
+		shutil.rmtree(self.path)
+
+	def write_file(self, name, content):
+		filename = os.path.join(self.path, name)
+		f = open(filename, "w")
+		f.write(content)
+		f.close()
+		return filename
+
+	def read_file(self, name):
+		return open(os.path.join(self.path, name)).read()
+
+	def test_store_restore(self):
+		key = ConversionCache.make_key("test", 1, "content")
+		self.assertFalse(self.cache.restore(key, {"out": os.path.join(self.path, "restored")}))
+
+		self.cache.store(key, {"out": self.write_file("out", "converted")}, {"references": [["!a", False, "a"]]})
+		self.assertTrue(self.cache.restore(key, {"out": os.path.join(self.path, "restored")}))
+		self.assertEqual(self.read_file("restored"), "converted")
+		self.assertFalse(self.cache.restore(key, {"out": os.path.join(self.path, "restored")}, lambda info: info["references"][0][2] == "b"))
+		self.assertNotEqual(key, ConversionCache.make_key("test", 1, "other content"))
+
+	def test_evict(self):
+		keys = [ConversionCache.make_key("test", i) for i in range(4)]
+		for key in keys[:3]:
+			self.cache.store(key, {"out": self.write_file("out", "x" * 300)})
+			os.utime(self.cache.get_entry_dir(key), (0, 0)) #entries with same mtime are evicted in any order
+		self.cache.restore(keys[0], {"out": os.path.join(self.path, "restored")})
+		self.cache.store(keys[3], {"out": self.write_file("out", "x" * 300)})
+
+		self.assertTrue(self.cache.restore(keys[0], {"out": os.path.join(self.path, "restored")}))
+		self.assertTrue(self.cache.restore(keys[3], {"out": os.path.join(self.path, "restored")}))
+		self.assertEqual(len(self.cache.get_entries()), 2)
+
+class TestMetadataCache(unittest.TestCase):
+	def setUp(self):
+		Logger.start(verbose=False)
+		self.path = tempfile.mkdtemp()
+		self.dbfile = os.path.join(self.path, "Metadata", "metadata.db")
+		self.cache = MetadataCache(2, self.dbfile)
+
+	def tearDown(self):
+		Logger.stop()
+		shutil.rmtree(self.path)
+
+	def write_file(self, name, content):
+		filename = os.path.join(self.path, name)
+		f = open(filename, "w")
+		f.write(content)
+		f.close()
+		return filename
+
+	def test_get_put(self):
+		filename = self.write_file("a.item", "{}")
+		key = MetadataCache.make_key(filename, "JSONExtractor/1")
+		self.assertIsNone(self.cache.get(key))
+		self.cache.put(key, {"title": u"A"})
+		metadata = self.cache.get(key)
+		self.assertEqual(metadata, {"title": u"A"})
+		metadata["title"] = u"changed"
+		self.assertEqual(self.cache.get(key), {"title": u"A"})
+
+		self.assertIsNone(self.cache.get(MetadataCache.make_key(filename, "JSONExtractor/2")))
+		self.write_file("a.item", "{\"title\": \"B\"}")
+		self.assertIsNone(self.cache.get(MetadataCache.make_key(filename, "JSONExtractor/1")))
+
+	def test_persistent(self):
+		keys = [MetadataCache.make_key(self.write_file(name, "{}"), "JSONExtractor/1") for name in ["a.item", "b.item", "c.item"]]
+		for key in keys:
+			self.cache.put(key, {"id": key[0]})
+		self.cache.put(keys[0], {"title": object()}) #can't be persisted
+
+		cache = MetadataCache(2, self.dbfile)
+		self.assertIsNone(cache.get(keys[0]))
+		self.assertEqual(cache.get(keys[1]), {"id": keys[1][0]})
+		self.assertEqual(MetadataCache(2).get(keys[1]), None)
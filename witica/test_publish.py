@@ -0,0 +1,70 @@
+# coding=utf-8
+
+import os, tempfile, shutil, time
+import unittest
+from threading import Event as TEvent
+
+from witica.log import *
+from witica import publish
+from witica.publish import FTPPublish
+
+
+class FailingFTPServer(object):
+	def __init__(self, failures = None):
+		self.idle_event = TEvent()
+		self.idle_event.set()
+		self.last_error = None
+		self.failures = failures #number of uploads that fail, None for all
+		self.uploads = []
+
+	def upload_file_async(self, local_path, server_path):
+		self.uploads.append(server_path)
+		if self.failures == None or len(self.uploads) <= self.failures:
+			self.last_error = IOError("550 Permission denied")
+		else:
+			self.last_error = None
+
+	def stop(self):
+		pass
+
+class TestFTPPublish(unittest.TestCase):
+	def setUp(self):
+		Logger.start(verbose=False)
+		self.path = tempfile.mkdtemp()
+		self.original_cache_folder = publish.cache_folder
+		publish.cache_folder = self.path
+		self.publish = FTPPublish("test", "web", {"type": "FTPPublish", "publish_id": "ftp", "domain": "localhost", "user": "test", "path": "/"})
+		self.publish.ftp_init = True
+		self.publish.ftp_server = FailingFTPServer()
+
+	def tearDown(self):
+		self.publish.close_queue()
+		[thread.join() for thread in self.publish.worker_threads]
+		publish.cache_folder = self.original_cache_folder
+		shutil.rmtree(self.path)
+		Logger.stop()
+
+	def test_failed_upload(self):
+		filename = os.path.join(self.path, "a.html")
+		f = open(filename, "w")
+		f.write("a")
+		f.close()
+		self.publish.publish_file(filename, "web/a.html")
+		while len(self.publish.pending_events) > 0:
+			time.sleep(0.1)
+		self.assertEqual(None, self.publish.manifest.get_hash("web/a.html")) #uploaded again next time
+
+	def test_publish_while_uploading(self):
+		filename = os.path.join(self.path, "a.html")
+		f = open(filename, "w")
+		f.write("a")
+		f.close()
+		self.publish.ftp_server = FailingFTPServer(failures = 1)
+		self.publish.ftp_server.idle_event.clear() #keep the first upload pending
+		self.publish.publish_file(filename, "web/a.html")
+		self.publish.publish_file(filename, "web/a.html") #not skipped, the pending upload fails
+		self.publish.ftp_server.idle_event.set()
+		while len(self.publish.pending_events) > 0:
+			time.sleep(0.1)
+		self.assertEqual(["web/a.html", "web/a.html"], self.publish.ftp_server.uploads)
+		self.assertNotEqual(None, self.publish.manifest.get_hash("web/a.html")) #second upload succeeded
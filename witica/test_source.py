@@ -1,11 +1,18 @@
 # coding=utf-8
 
-import os
+import os, tempfile, shutil, time, calendar, hashlib, zipfile, threading
 import unittest
 import pkg_resources
+from datetime import datetime
+from threading import Timer
 
-from witica.source import Source, SourceItemList
+from dropbox import files
+
+from witica import source, inotify, cache
+from witica.source import Source, SourceItemList, DropboxSource, LocalFolder
 from witica.log import *
+from witica.util import Event, sstr
+from witica.check import IntegrityChecker
 from witica.metadata import extractor
 
 
@@ -21,7 +28,7 @@ class TestSourceItemList(unittest.TestCase):
 		extractor.register_default_extractors()
 
 	def tearDown(self):
-		extractor.registered_extractors = []
+		extractor.unregister_all()
 		pkg_resources.cleanup_resources()
 		Logger.stop()
 
@@ -40,6 +47,397 @@ class TestSourceItemList(unittest.TestCase):
 	def test_item_exists(self):
 		self.assertTrue(self.source.items["simple"].exists)
 
+	def test_index_update(self):
+		self.assertEqual(["simple.md"], self.source.items["simple"].files)
+		self.source.index.remove_path("simple.md")
+		self.assertFalse(self.source.item_exists("simple"))
+		self.assertEqual(8, len(self.source.items))
+		self.source.index.add_file("simple.md")
+		self.assertTrue(self.source.item_exists("simple"))
+		self.assertEqual(9, len(self.source.items))
+
+	def test_item_memoization(self):
+		item = self.source.items["simple"]
+		self.assertEqual("simple.md", item.contentfile)
+		self.assertFalse(hasattr(item, "__dict__"))
+		self.source.index.remove_path("simple.md")
+		self.assertEqual(None, item.contentfile) #values are computed again after the index changed
+		self.assertFalse(item.exists)
+		self.source.index.add_file("simple.md")
+		self.assertEqual(["simple.md"], item.files)
+
+	def test_metadata_extracted_again(self):
+		filename = self.source.get_absolute_path("simple.md")
+		md_extractor = extractor.get_filetype("md").extractor
+		key = cache.metadata_cache.make_key(filename, type(md_extractor).__name__ + "/" + sstr(md_extractor.version))
+		cache.metadata_cache.put(key, {"title": u"stale"})
+		self.assertEqual(u"stale", self.source.items["simple"].metadata["title"])
+
+		cache.metadata_cache.clear() #as done by rebuild -f
+		source = FolderSource("test", {"version": 1, "path": self.resource_path})
+		self.assertNotEqual(u"stale", source.items["simple"].metadata.get("title"))
+
+	def test_persistent_index(self):
+		db_path = tempfile.mkdtemp()
+		try:
+			db_filename = os.path.join(db_path, "test.index")
+			self.source.index.open(db_filename, "cursor1")
+			self.source.index.remove_path("simple.md")
+			self.source.index.commit("cursor1")
+
+			source = FolderSource("test", {"version": 1, "path": self.resource_path})
+			source.index.open(db_filename, "cursor1")
+			self.assertFalse(source.item_exists("simple")) #loaded from the database, not from the folder
+
+			source = FolderSource("test", {"version": 1, "path": self.resource_path})
+			source.index.open(db_filename, "cursor2")
+			self.assertTrue(source.item_exists("simple")) #rebuilt, because the cursor changed
+		finally:
+			shutil.rmtree(db_path)
+
+	def test_get_items(self):
+		self.assertEqual(["broken_json", "nested_json"], [item.item_id for item in self.source.items.get_items("*_json")])
+		self.assertEqual(["simple"], [item.item_id for item in self.source.items.get_items("sim?le")])
+		self.assertEqual(["simple"], [item.item_id for item in self.source.items.get_items("simple")])
+		self.assertEqual([], self.source.items.get_items("simple2"))
+		self.assertEqual(["special_characters", u"special_item_id_öäüß¡““¢≠}{|¢¶“∞…–∞œäö()"], self.source.index.get_item_ids("spec"))
+
+
+class TestDropboxSource(unittest.TestCase):
+	def setUp(self):
+		Logger.start(verbose=False)
+		extractor.register_default_extractors()
+
+		self.cache_path = tempfile.mkdtemp()
+		self.dbx = FakeDropbox()
+		self.dbx.add_file(u"/site/a.md", "# A")
+		self.dbx.add_file(u"/site/b.md", "# B")
+		self.dbx.add_file(u"/site/blog/c.md", "# C")
+		self.dbx.add_file(u"/site/blog/d.md", "# D")
+		self.dbx.add_file(u"/site/meta/web.target", "{}")
+		self.source = FakeDropboxSource("test", {"version": 1, "app_key": "", "app_secret": "", "download_workers": 3}, self.dbx, self.cache_path)
+
+	def tearDown(self):
+		extractor.unregister_all()
+		shutil.rmtree(self.cache_path)
+		Logger.stop()
+
+	def read_cache(self, local_path):
+		return open(self.source.get_absolute_path(local_path)).read()
+
+	def test_update_cache(self):
+		self.source.update_cache()
+		self.assertEqual(["a", "b", "blog/c", "blog/d"], [item.item_id for item in self.source.items])
+		self.assertEqual("# C", self.read_cache("blog/c.md"))
+		self.assertEqual(self.dbx.mtime, os.path.getmtime(self.source.get_absolute_path("blog/c.md")))
+		self.assertEqual(self.dbx.cursor, self.source.cache_cursor)
+
+	def test_update_cache_delta(self):
+		self.source.update_cache()
+		self.dbx.add_file(u"/site/a.md", "# A2")
+		self.dbx.delete(u"/site/b.md")
+		self.dbx.add_file(u"/site/b.md", "# B2")
+		self.dbx.add_file(u"/site/blog/e.md", "# E")
+		self.dbx.delete(u"/site/blog")
+		self.dbx.add_file(u"/site/f.md", "# F")
+		self.source.update_cache()
+		self.assertEqual(["a", "b", "f"], [item.item_id for item in self.source.items])
+		self.assertEqual("# A2", self.read_cache("a.md"))
+		self.assertEqual("# B2", self.read_cache("b.md"))
+		self.assertFalse(os.path.exists(self.source.get_absolute_path("blog")))
+		self.assertEqual(self.dbx.cursor, self.source.cache_cursor)
+
+	def test_fetch_changes(self):
+		self.dbx.max_zip_files = 0 #download files one by one
+		changes, cursors = [], []
+		change_event = Event()
+		change_event += lambda sender, change: changes.append(str(change))
+		cursor = self.source.fetch_changes(change_event, None, lambda sender, cursor: cursors.append(cursor))
+		self.assertEqual(["<ItemChanged a>", "<ItemChanged b>", "<ItemChanged blog/c>", "<ItemChanged blog/d>", "<MetaChanged web.target>"], changes)
+		self.assertEqual([u"l2", u"l4", u"l6", self.dbx.cursor], cursors) #checkpoint after every page
+		self.assertEqual(self.dbx.cursor, cursor)
+
+		self.dbx.delete(u"/site/a.md")
+		changes = []
+		self.assertEqual(self.dbx.cursor, self.source.fetch_changes(change_event, cursor))
+		self.assertEqual(["<ItemRemoved a>"], changes)
+
+	def test_bootstrap_cache(self):
+		changes, cursors = [], []
+		change_event = Event()
+		change_event += lambda sender, change: changes.append(str(change))
+		self.source.fetch_changes(change_event, None, lambda sender, cursor: cursors.append(cursor))
+		self.assertEqual([u"/site"], self.dbx.zip_downloads)
+		self.assertEqual([], self.dbx.downloads)
+		self.assertEqual(5, len(changes))
+		self.assertEqual([self.dbx.cursor], cursors)
+		self.assertEqual("# C", self.read_cache("blog/c.md"))
+		self.assertEqual(self.dbx.mtime, os.path.getmtime(self.source.get_absolute_path("blog/c.md")))
+		self.assertFalse(os.path.exists(self.source.source_dir + ".zip"))
+
+		self.dbx.add_file(u"/site/a.md", "# A2")
+		self.source.update_cache() #continues with deltas from the listing cursor
+		self.assertEqual([u"/site/a.md"], self.dbx.downloads)
+
+	def test_poll_changes(self):
+		self.source.fetch_changes(Event(), None, self.source.save_cursor)
+		self.dbx.backoff = 1
+		self.dbx.add_file(u"/site/a.md", "# A2")
+		self.source.update_change_status()
+		self.assertTrue(self.source.changes_available)
+		self.source.fetch_changes(Event(), self.source.state["cursor"], self.source.save_cursor)
+
+		Timer(0.2, self.source.stop).start()
+		start = time.time()
+		self.source.update_change_status() #no changes, returns when the source is stopped
+		self.assertFalse(self.source.changes_available)
+		self.assertTrue(time.time() - start < self.dbx.longpoll_timeout)
+		self.assertEqual(1, len([t for t in threading.enumerate() if t.name.endswith("(longpoll)")]))
+
+	def test_fetch_changes_single_pass(self):
+		self.source.fetch_changes(Event(), None)
+		self.dbx.add_file(u"/site/a.md", "# A2")
+		self.dbx.listed_cursors = []
+		changes = []
+		change_event = Event()
+		change_event += lambda sender, change: changes.append(str(change))
+		cursor = self.source.fetch_changes(change_event, self.source.cache_cursor)
+		self.assertEqual(["<ItemChanged a>"], changes)
+		self.assertEqual("# A2", self.read_cache("a.md"))
+		self.assertEqual(1, len(self.dbx.listed_cursors)) #cache and changes from the same delta
+		self.assertEqual(self.dbx.cursor, self.source.cache_cursor)
+
+	def test_fetch_lagging_changes(self):
+		self.source.update_cache()
+		changes = []
+		change_event = Event()
+		change_event += lambda sender, change: changes.append(str(change))
+		self.assertEqual(self.dbx.cursor, self.source.fetch_changes(change_event, None))
+		self.assertEqual(5, len(changes))
+
+	def test_skip_unchanged_files(self):
+		self.source.update_cache()
+		self.dbx.downloads = []
+		self.dbx.add_file(u"/site/a.md", "# A")
+		self.dbx.add_file(u"/site/b.md", "# B2")
+		self.source.update_cache()
+		self.assertEqual([u"/site/b.md"], self.dbx.downloads)
+		self.assertEqual("# B2", self.read_cache("b.md"))
+
+	def test_reconcile_cache(self):
+		self.source.update_cache()
+		self.dbx.downloads = []
+		self.dbx.add_file(u"/site/b.md", "# B2")
+		self.dbx.delete(u"/site/blog/d.md")
+		open(self.source.get_absolute_path("stale.md"), "w").write("# Stale")
+		self.source.cache_cursor = u"invalid"
+		self.source.update_cache()
+		self.assertEqual([u"/site/b.md"], self.dbx.downloads)
+		self.assertEqual(["a", "b", "blog/c"], [item.item_id for item in self.source.items])
+		self.assertFalse(os.path.exists(self.source.get_absolute_path("stale.md")))
+		self.assertFalse(os.path.exists(self.source.get_absolute_path("blog/d.md")))
+		self.assertEqual(self.dbx.cursor, self.source.cache_cursor)
+
+class TestLocalFolder(unittest.TestCase):
+	def setUp(self):
+		Logger.start(verbose=False)
+		extractor.register_default_extractors()
+
+		self.folder_path = tempfile.mkdtemp()
+		self.cache_path = tempfile.mkdtemp()
+		self.original_cache_folder = source.cache_folder
+		source.cache_folder = self.cache_path
+		os.makedirs(os.path.join(self.folder_path, "blog"))
+		os.makedirs(os.path.join(self.folder_path, "meta"))
+		self.write("a.md", "# A")
+		self.write("blog/c.md", "# C")
+		self.write("meta/web.target", "{}")
+		self.source = self.create_source()
+
+		self.changes = []
+		self.change_event = Event()
+		self.change_event += lambda sender, change: self.changes.append(str(change))
+
+	def tearDown(self):
+		source.cache_folder = self.original_cache_folder
+		extractor.unregister_all()
+		shutil.rmtree(self.folder_path)
+		shutil.rmtree(self.cache_path)
+		Logger.stop()
+
+	def create_source(self):
+		return LocalFolder("test", {"version": 1, "type": "LocalFolder", "path": self.folder_path})
+
+	def write(self, local_path, content, mtime = 1500000000):
+		filename = os.path.join(self.folder_path, local_path)
+		open(filename, "w").write(content)
+		os.utime(filename, (mtime, mtime))
+
+	def fetch_changes(self):
+		self.changes = []
+		self.source.fetch_changes(self.change_event, self.source.state["cursor"], self.source.save_cursor)
+		return self.changes
+
+	def test_fetch_changes(self):
+		self.assertEqual(["<ItemChanged a>", "<ItemChanged blog/c>", "<MetaChanged web.target>"], self.fetch_changes())
+		self.assertEqual([], self.fetch_changes())
+
+		self.write("a.md", "# A2")
+		os.remove(os.path.join(self.folder_path, "blog/c.md"))
+		self.write("b.md", "# B")
+		self.write(".b.md.swp", "")
+		self.assertEqual(["<ItemChanged a>", "<ItemChanged b>", "<ItemRemoved blog/c>"], self.fetch_changes())
+		self.assertEqual(["a", "b"], [item.item_id for item in self.source.items])
+
+	def test_mixed_case(self):
+		os.makedirs(os.path.join(self.folder_path, "Blog"))
+		self.write("Blog/Post.md", "# Post")
+		self.write("a.md", "# A\n[post](!Blog/Post) !(!Blog/Post)")
+		self.fetch_changes()
+		item = self.source.items["a"]
+		self.assertEqual(u"Blog/Post", self.source.resolve_reference("!Blog/Post", item))
+		self.assertEqual(u"Blog/Post", self.source.resolve_reference("!Blog/*", item, allow_patterns = True))
+		self.assertEqual(set([u"Blog/Post"]), item.get_references())
+		self.assertEqual([], [sstr(fault) for fault in IntegrityChecker(self.source).check(item)])
+
+	def test_changes_while_stopped(self):
+		self.fetch_changes()
+		self.source.stop()
+		self.write("a.md", "# A2")
+		shutil.rmtree(os.path.join(self.folder_path, "blog"))
+
+		self.source = self.create_source()
+		self.assertEqual(["<ItemChanged a>", "<ItemRemoved blog/c>"], self.fetch_changes())
+
+	def test_lagging_cursor(self):
+		self.fetch_changes()
+		self.changes = []
+		cursor = self.source.fetch_changes(self.change_event, u"0")
+		self.assertEqual(self.source.state["cursor"], cursor)
+		self.assertEqual(3, len(self.changes)) #all files are passed again
+
+	@unittest.skipUnless(inotify.is_supported(), "inotify is not available")
+	def test_watch_changes(self):
+		self.source.update_change_status()
+		self.fetch_changes()
+
+		os.makedirs(os.path.join(self.folder_path, "blog/new"))
+		self.write("blog/new/d.md", "# D")
+		self.source.update_change_status()
+		self.assertTrue(self.source.changes_available)
+		self.assertEqual(["<ItemChanged blog/new/d>"], self.fetch_changes())
+		self.source.watcher.close()
+
+
+class FakeDropbox(object):
+	"""Local stand-in for the Dropbox API, serving files from memory"""
+
+	def __init__(self, page_size = 2):
+		self.page_size = page_size
+		self.files = {} #path -> content
+		self.changes = [] #list of metadata objects
+		self.downloads = [] #downloaded paths
+		self.listed_cursors = [] #cursors passed to files_list_folder_continue
+		self.zip_downloads = [] #folders downloaded as zip archive
+		self.max_zip_files = None #number of files up to which folders can be downloaded as zip
+		self.backoff = None #backoff returned by longpoll requests
+		self.mtime = calendar.timegm(datetime(2017, 8, 12, 10, 0, 0).timetuple())
+
+	def get_metadata(self, path):
+		if path in self.files:
+			block_hashes = "".join([hashlib.sha256(self.files[path][i:i+4*1024*1024]).digest() for i in range(0, len(self.files[path]), 4*1024*1024)])
+			return files.FileMetadata(name = path.rpartition("/")[2], id = u"id:" + path, 
+				client_modified = datetime.utcfromtimestamp(self.mtime), server_modified = datetime.utcfromtimestamp(self.mtime),
+				rev = u"0123456789", size = len(self.files[path]), path_lower = path, path_display = path,
+				content_hash = hashlib.sha256(block_hashes).hexdigest())
+		elif any(p.startswith(path + "/") for p in self.files):
+			return files.FolderMetadata(name = path.rpartition("/")[2], id = u"id:" + path, path_lower = path, path_display = path)
+		else:
+			return files.DeletedMetadata(name = path.rpartition("/")[2], path_lower = path, path_display = path)
+
+	def get_listing(self):
+		"""returns metadata of all existing files and folders"""
+		paths = set()
+		for path in self.files:
+			paths.add(path)
+			while path.rpartition("/")[0] != u"":
+				path = path.rpartition("/")[0]
+				paths.add(path)
+		return [self.get_metadata(path) for path in sorted(paths)]
+
+	def add_file(self, path, content):
+		directory = path.rpartition("/")[0]
+		if directory and not any(p.startswith(directory + "/") for p in self.files):
+			self.changes.append(files.FolderMetadata(name = directory.rpartition("/")[2], id = u"id:" + directory, path_lower = directory, path_display = directory))
+		self.files[path] = content
+		self.changes.append(self.get_metadata(path))
+
+	def delete(self, path):
+		for p in [p for p in self.files if p == path or p.startswith(path + "/")]:
+			del self.files[p]
+		self.changes.append(self.get_metadata(path))
+
+	def get_cursor(self):
+		return u"c" + unicode(len(self.changes))
+
+	def page(self, entries, position):
+		has_more = len(entries) > self.page_size
+		return files.ListFolderResult(entries = entries[:self.page_size], cursor = u"c" + unicode(position + min(len(entries), self.page_size)), has_more = has_more)
+
+	def files_list_folder(self, path, recursive = False):
+		self.listing = self.get_listing()
+		self.listing_cursor = self.cursor
+		return self.files_list_folder_continue(u"l0")
+
+	def files_list_folder_continue(self, cursor):
+		self.listed_cursors.append(cursor)
+		if cursor.startswith(u"l"): #continue full listing
+			position = int(cursor[1:])
+			result = files.ListFolderResult(entries = self.listing[position:position+self.page_size], cursor = u"l" + unicode(position+self.page_size), has_more = True)
+			if position + self.page_size >= len(self.listing):
+				result.has_more = False
+				result.cursor = self.listing_cursor
+			return result
+		if not cursor.startswith(u"c") or int(cursor[1:]) > len(self.changes):
+			raise ValueError("Invalid cursor " + cursor)
+		position = int(cursor[1:])
+		return self.page(self.changes[position:], position)
+
+	def files_download_to_file(self, download_path, path):
+		self.downloads.append(path)
+		time.sleep(0.01)
+		with open(download_path, "wb") as f:
+			f.write(self.files[path])
+
+	def files_list_folder_longpoll(self, cursor, timeout = 30):
+		self.longpoll_timeout = timeout
+		start = time.time()
+		while int(cursor[1:]) == len(self.changes) and time.time() - start < timeout:
+			time.sleep(0.01)
+		return files.ListFolderLongpollResult(changes = int(cursor[1:]) < len(self.changes), backoff = self.backoff)
+
+	def files_download_zip_to_file(self, download_path, path):
+		contained = sorted([p for p in self.files if p.startswith(path + "/")])
+		if self.max_zip_files != None and len(contained) > self.max_zip_files:
+			raise ValueError("Too many files in " + path)
+		self.zip_downloads.append(path)
+		with zipfile.ZipFile(download_path, "w") as archive:
+			for p in contained:
+				archive.writestr(path.rpartition("/")[2] + p[len(path):], self.files[p])
+
+	cursor = property(get_cursor)
+
+class FakeDropboxSource(DropboxSource):
+	def __init__(self, source_id, config, dbx, cache_path):
+		super(FakeDropboxSource, self).__init__(source_id, config)
+		self.path_prefix = u"/site"
+		self.source_dir = os.path.join(cache_path, source_id)
+		self.state_filename = os.path.join(cache_path, source_id + ".source")
+		self.index_filename = os.path.join(cache_path, source_id + ".index")
+		self.state = {}
+		self.load_state()
+		self.index.open(self.index_filename, self.cache_cursor)
+		self.dbx = dbx
 
 class FolderSource(Source):
 	def __init__(self, source_id, config, prefix = ""):
@@ -1,10 +1,9 @@
 # coding=utf8
-import os, shutil, ctypes
+import os, shutil, hashlib, json, errno, sqlite3
 from datetime import datetime
 from collections import deque
 from abc import ABCMeta, abstractmethod
-from threading import Event as TEvent, Thread, Lock
-import time
+from threading import Event as TEvent, Thread, Lock, Condition
 import platform
 
 from witica.log import *
@@ -12,13 +11,27 @@ from witica.log import *
 def throw(ex,msg,innerEx):
 	raise ex(msg +  ".\n  ﹂" + innerEx.__class__.__name__ + ": " + sstr(innerEx))
 
+def makedirs(directory):
+	"""creates a directory including its parents, if it doesn't exist yet (also when created concurrently by another thread)"""
+	try:
+		os.makedirs(directory)
+	except OSError, e:
+		if not(e.errno == errno.EEXIST and os.path.isdir(directory)):
+			raise
+
 def copyfile(src,dst):
 	"""copies a file from src to dst and creates the destination directory if necessary"""
-	directory = dst.rpartition("/")[0]
-	if not os.path.exists(directory):
-		os.makedirs(directory)
+	makedirs(dst.rpartition("/")[0])
 	shutil.copyfile(src, dst)
 
+def open_database(filename):
+	"""opens a sqlite database that is written with a commit per change from several threads
+	in WAL mode with synchronous=NORMAL a commit doesn't wait for the disk, only the last commits can be lost on power loss"""
+	db = sqlite3.connect(filename, check_same_thread = False)
+	db.execute("PRAGMA journal_mode=WAL")
+	db.execute("PRAGMA synchronous=NORMAL")
+	return db
+
 def sstr(obj):
 	""" converts any object to str, if necessary encodes unicode chars """
 	try:
@@ -55,6 +68,19 @@ def confirm(prompt_str, allow_empty=False, default=False):
 		else:
 			print("Please enter y or n.")
 
+def dropbox_content_hash(filename):
+	"""computes the content hash Dropbox stores for a file (sha256 of the sha256 hashes of its 4 MB blocks)"""
+	block_hashes = ""
+	f = open(filename, "rb")
+	try:
+		while True:
+			block = f.read(4*1024*1024)
+			if not block: break
+			block_hashes += hashlib.sha256(block).digest()
+	finally:
+		f.close()
+	return hashlib.sha256(block_hashes).hexdigest()
+
 def get_cache_folder(name):
 	if platform.system() == "Darwin":
 		return os.path.expanduser(os.path.join("~/Library/Caches/org.witica",name))
@@ -84,11 +110,172 @@ class Event(object):
 	__isub__ = remove
 	__call__ = fire
 
+class EventJournal(object):
+	"""Append-only log of the operations on the queue of an AsyncWorker, from which the queue can be restored after a restart
+
+	Records are flushed to the operating system, but not synced to the disk, so the journal survives a crash of the
+	process, but records written shortly before a crash of the system can be lost."""
+
+	COMPACT_MIN_RECORDS = 1000 #journal is only compacted if it contains more records than this
+
+	def __init__(self, filename, to_json, from_json):
+		self.filename = filename
+		self.to_json = to_json
+		self.from_json = from_json
+		self.records = 0
+		self.file = None
+
+	def exists(self):
+		return os.path.isfile(self.filename)
+
+	def replay(self):
+		"""returns the events in the queue as recorded in the journal"""
+		events = deque()
+		if not self.exists():
+			return events
+		f = open(self.filename, "r")
+		try:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					break #incomplete record written when the process was killed
+				if record["op"] == "enqueue":
+					events.append(self.from_json(record["event"]))
+				elif record["op"] == "ack":
+					events.popleft()
+				elif record["op"] == "remove":
+					del events[record["index"]]
+				elif record["op"] == "update":
+					events[record["index"]] = self.from_json(record["event"])
+		finally:
+			f.close()
+		return deque([event for event in events if event != None])
+
+	def write(self, record):
+		if self.file == None:
+			self.file = open(self.filename, "a")
+		self.file.write(json.dumps(record, encoding="utf-8") + "\n")
+		self.file.flush() #no fsync, it would block the queue on every change
+		self.records += 1
+
+	def enqueue(self, event):
+		self.write({"op": "enqueue", "event": self.to_json(event)})
+
+	def ack(self):
+		"""records that the first event in the queue was processed"""
+		self.write({"op": "ack"})
+
+	def remove(self, index):
+		self.write({"op": "remove", "index": index})
+
+	def update(self, index, event):
+		self.write({"op": "update", "index": index, "event": self.to_json(event)})
+
+	def needs_compaction(self, queue_length):
+		return self.records > max(self.COMPACT_MIN_RECORDS, 2 * queue_length)
+
+	def compact(self, events):
+		"""replaces the journal by the enqueue records of the events currently in the queue"""
+		self.close()
+		f = open(self.filename + ".tmp", "w")
+		try:
+			for event in events:
+				f.write(json.dumps({"op": "enqueue", "event": self.to_json(event)}, encoding="utf-8") + "\n")
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+		os.rename(self.filename + ".tmp", self.filename)
+		self.records = len(events)
+
+	def delete(self):
+		self.close()
+		if self.exists():
+			os.remove(self.filename)
+		self.records = 0
+
+	def close(self):
+		if self.file != None:
+			self.file.close()
+			self.file = None
+
+class Deferred(object):
+	"""Result of an operation that completes asynchronously, i.e. in another process"""
+
+	def __init__(self):
+		self._lock = Lock()
+		self._callbacks = []
+		self.done = False
+		self.result = None
+		self.error = None #exception if the operation failed
+
+	def add_callback(self, callback):
+		"""calls callback with the deferred as soon as the operation completed"""
+		with self._lock:
+			if not self.done:
+				self._callbacks.append(callback)
+				return
+		callback(self)
+
+	def resolve(self, result = None):
+		self._complete(result, None)
+
+	def fail(self, error):
+		self._complete(None, error)
+
+	def _complete(self, result, error):
+		with self._lock:
+			if self.done:
+				raise RuntimeError("Deferred was already completed")
+			self.done, self.result, self.error = True, result, error
+			callbacks, self._callbacks = self._callbacks, []
+		for callback in callbacks:
+			callback(self)
+
+	def then(self, function):
+		"""returns a deferred for the result of function called with the result of this one, errors are passed on"""
+		deferred = Deferred()
+		def callback(d):
+			if d.error:
+				deferred.fail(d.error)
+				return
+			try:
+				result = function(d.result)
+			except Exception, e:
+				deferred.fail(e)
+				return
+			deferred.resolve(result)
+		self.add_callback(callback)
+		return deferred
+
+	@staticmethod
+	def gather(deferreds):
+		"""returns a deferred for the list of results of all deferreds, that fails with the first error after all completed"""
+		deferred = Deferred()
+		pending = [len(deferreds)]
+		lock = Lock()
+		def callback(d):
+			with lock:
+				pending[0] -= 1
+				if pending[0] > 0: return
+			errors = [d.error for d in deferreds if d.error]
+			if errors:
+				deferred.fail(errors[0])
+			else:
+				deferred.resolve([d.result for d in deferreds])
+		if len(deferreds) == 0:
+			deferred.resolve([])
+		for d in deferreds:
+			d.add_callback(callback)
+		return deferred
+
 class AsyncWorker(Loggable):
 	__metaclass__ = ABCMeta
 
 	"""Abstract asynchronous worker class that processes queued events"""
 	#to be able to use the class implement process_event(), load_state() and write_state()
+	#if load_state() opens a journal, changes of the queue are appended to it instead of calling write_state()
 
 	@abstractmethod
 	def process_event(self,event):
@@ -100,13 +287,30 @@ class AsyncWorker(Loggable):
 			self.log_id = name
 			self.pending_events = deque()
 			self.pending_events_lock = Lock()
+			self.pending_events_changed = Condition(self.pending_events_lock) #notified on new events, close_queue() and stop()
+			self.pending_keys = {} #key -> pending event that later events with the same key are merged into
+			self.processing = [] #events that are being processed
+			self.completions = deque() #functions to be run on a worker thread, see call_in_worker()
+			self.queue_empty_pending = False #queue became empty and queue_empty() wasn't called since
+			self.calling_queue_empty = False
+			if not hasattr(self, "workers"):
+				self.workers = 1 #number of events processed at the same time
+			self.running_workers = 0
+			self.journal = None #EventJournal the queue is persisted in
 			self._stop = TEvent()
 			self.stoppedEvent = Event()
 			self.accept_events = True
 			self.load_state()
-			self.worker_thread = Thread(target=self.work, name = name)
-
-			self.worker_thread.start()
+			for event in self.pending_events:
+				if self.is_barrier(event): #later events are not merged into events before a barrier
+					self.pending_keys.clear()
+				self.pending_keys[self.get_event_key(event)] = event
+			self.pending_keys.pop(None, None)
+			self.worker_threads = [Thread(target=self.work, name = name + (" #" + str(i+1) if self.workers > 1 else "")) for i in range(self.workers)]
+			self.worker_thread = self.worker_threads[0]
+
+			self.running_workers = self.workers
+			[thread.start() for thread in self.worker_threads]
 			self.log("Initialized " + name + ".", Logtype.DEBUG)
 		except Exception, e:
 			self.log("Initializing " + name + " failed.", Logtype.ERROR)
@@ -124,79 +328,226 @@ class AsyncWorker(Loggable):
 
 	@abstractmethod
 	def process_event(self,event):
-		doc = "Processes the event that is first in the queue"
+		doc = "Processes the event that is first in the queue, can return a Deferred if processing completes asynchronously"
+
+	def open_journal(self, filename, to_json, from_json):
+		"""persists the queue in an append-only journal and restores the events recorded in it"""
+		self.journal = EventJournal(filename, to_json, from_json)
+		if self.journal.exists():
+			self.pending_events.clear()
+			self.pending_events.extend(self.journal.replay())
+		self.journal.compact(self.pending_events) #also removes a partially written last record
+
+	def record(self, operation, *args):
+		"""records an operation on the queue, must be called while holding the pending_events_lock"""
+		if self.journal:
+			getattr(self.journal, operation)(*args)
+			if self.journal.needs_compaction(len(self.pending_events)):
+				self.journal.compact(self.pending_events)
+
+	def get_pending_index(self, event):
+		for index, pending in enumerate(self.pending_events):
+			if pending is event:
+				return index
+		raise ValueError("Event is not in the queue")
+
+	def get_event_key(self, event):
+		doc = "Returns a key identifying the events that can be merged with this one or None if it can't be merged"
+		return None
+
+	def merge_events(self, pending, event):
+		doc = "Returns the event replacing the pending event and the new event with the same key or None to enqueue the new event separately, only called if there is no barrier between them"
+		return None
+
+	def is_barrier(self, event):
+		doc = "Returns True if the event may only be processed after all events before it and before all events after it"
+		return False
+
+	def is_processing(self, event):
+		return any(event is e for e in self.processing)
+
+	def next_event(self):
+		"""returns the first pending event that can be processed now or None, must be called while holding the pending_events_lock"""
+		blocked_keys = set() #events with the same key are processed in order
+		started = 0 #number of events before the current one that are being processed
+		for index, event in enumerate(self.pending_events):
+			key = self.get_event_key(event)
+			if self.is_processing(event):
+				if self.is_barrier(event):
+					return None
+				blocked_keys.add(key)
+				started += 1
+			elif self.is_barrier(event):
+				return event if len(self.processing) == 0 else None
+			elif key == None: #events without key are started in order
+				return event if index == started else None
+			elif not key in blocked_keys:
+				return event
+		return None
 
 	def work(self):
 		self.log("Worker thread started.", Logtype.DEBUG)
 
-		while not self._stop.is_set():
-			event = None
-			while not(self._stop.is_set()) and len(self.pending_events) == 0:
-				if self.accept_events:
-					time.sleep(1)
+		while True:
+			with self.pending_events_lock:
+				event = self.next_event()
+				while event == None and len(self.completions) == 0 and not(self._stop.is_set()) and (self.accept_events or len(self.pending_events) > 0 or self.queue_empty_pending or self.calling_queue_empty):
+					self.pending_events_changed.wait()
+					event = self.next_event()
+				if len(self.completions) > 0: #complete asynchronously processed events first
+					completion, event = self.completions.popleft(), None
+				elif event == None: #stopped or queue was closed and all events are processed
+					break
 				else:
-					self.stoppedEvent(self,None)
-					self.log("Worker thread stopped.", Logtype.DEBUG)
-					return
-				
-			if self._stop.is_set(): break
+					self.processing.append(event) #prevent later events being merged into it
 
-			self.log("Pending events in queue: " + sstr(len(self.pending_events)), Logtype.DEBUG)
+			if event == None:
+				try:
+					completion()
+				except Exception, e:
+					self.log_exception("Completing an asynchronously processed event failed.", Logtype.ERROR)
+				continue
 
-			event = self.pending_events[0] #peek next event
 			self.log("Processing event " + sstr(event) + "...", Logtype.DEBUG)
 
 			try:
-				self.process_event(event)
+				result = self.process_event(event)
 			except Exception, e:
 				self.log_exception("Processing event " + sstr(event) + " failed.", Logtype.ERROR)
+				self.event_failed(event, e)
+				result = None
 
 			if self._stop.is_set(): break
 
-			self.pending_events_lock.acquire()
-			try:
-				self.pending_events.popleft()
-			except Exception, e:
-				self.log_exception("Could not pop event.", Logtype.ERROR)
-			finally:
-				self.pending_events_lock.release()
+			if isinstance(result, Deferred): #finished asynchronously, continue with the next event meanwhile
+				result.add_callback(lambda deferred, event=event: self.call_in_worker(lambda: self.finish_event(event, deferred.error)))
+			else:
+				self.finish_event(event)
 
-			self.write_state()
+		with self.pending_events_lock:
+			self.running_workers -= 1
+			last_worker = self.running_workers == 0
+		if last_worker:
+			self.stoppedEvent(self,None)
+			self.log("Worker thread stopped.", Logtype.DEBUG)
 
-			if len(self.pending_events) == 0:
+	def finish_event(self, event, error = None):
+		"""removes a processed event from the queue"""
+		if self._stop.is_set(): #keep the event in the queue to process it again after restart
+			return
+
+		if error:
+			self.log("Processing event " + sstr(event) + " failed.\n" + error.__class__.__name__ + ": " + sstr(error), Logtype.ERROR)
+			self.event_failed(event, error)
+
+		self.pending_events_lock.acquire()
+		try:
+			index = self.get_pending_index(event)
+			del self.pending_events[index]
+			if index == 0:
+				self.record("ack")
+			else:
+				self.record("remove", index)
+			key = self.get_event_key(event)
+			if key != None and self.pending_keys.get(key) is event:
+				del self.pending_keys[key]
+		except Exception, e:
+			self.log_exception("Could not pop event.", Logtype.ERROR)
+		finally:
+			self.processing = [e for e in self.processing if not(e is event)]
+			if len(self.pending_events) == 0: #keeps the workers of a closed queue running until queue_empty() was called
 				self.log("Pending events in queue: 0", Logtype.DEBUG)
+				self.queue_empty_pending = True
+			self.pending_events_changed.notify_all() #events blocked by this one can be processed now
+			self.pending_events_lock.release()
 
-		self.stoppedEvent(self,None)
-		self.log("Worker thread stopped.", Logtype.DEBUG)
+		if not self.journal:
+			self.write_state()
+		self.call_queue_empty()
+
+	def call_queue_empty(self):
+		"""calls queue_empty() if the queue became empty, without holding the lock and only on one thread at a time"""
+		while True:
+			with self.pending_events_lock:
+				if self.calling_queue_empty or not self.queue_empty_pending: #called again by the other thread if pending
+					return
+				self.queue_empty_pending = False
+				if len(self.pending_events) > 0: #called when the new events are processed
+					self.pending_events_changed.notify_all()
+					return
+				self.calling_queue_empty = True
+			try:
+				self.queue_empty()
+			except Exception, e:
+				self.log_exception("Finishing the processed events failed.", Logtype.ERROR)
+			finally:
+				with self.pending_events_lock:
+					self.calling_queue_empty = False
+					self.pending_events_changed.notify_all() #workers of a closed queue can stop now
+
+	def call_in_worker(self, function):
+		"""runs function on one of the worker threads, used to complete events processed in other threads or processes"""
+		with self.pending_events_lock:
+			self.completions.append(function)
+			self.pending_events_changed.notify()
+
+	def queue_empty(self):
+		"""called once when all events in the queue were processed, before the workers of a closed queue stop"""
+		pass
+
+	def event_failed(self, event, error):
+		"""called when processing an event failed, before it is removed from the queue"""
+		pass
 
 	def enqueue_event(self, sender, earg):
 		if not self.accept_events:
 			raise RuntimeError("Worker doesn't accept new events")
+		self.add_event(earg)
+
+	def add_event(self, earg):
+		"""adds an event to the queue, unlike enqueue_event() also after the queue was closed, i.e. for follow-up events while processing"""
 		self.pending_events_lock.acquire()
 		try:
-			self.pending_events.append(earg)
+			key = self.get_event_key(earg)
+			pending = self.pending_keys.get(key) if key != None else None
+			merged = None
+			if pending != None and not(self.is_processing(pending)):
+				merged = self.merge_events(pending, earg)
+
+			if merged == None:
+				self.pending_events.append(earg)
+				self.record("enqueue", earg)
+				self.pending_events_changed.notify_all()
+			elif merged is pending:
+				if self.journal:
+					self.record("update", self.get_pending_index(pending), pending)
+			else: #merged event replaces the pending one
+				index = self.get_pending_index(pending)
+				del self.pending_events[index]
+				self.record("remove", index)
+				self.pending_events.append(merged)
+				self.record("enqueue", merged)
+				self.pending_events_changed.notify_all()
+			if (merged == None or not(merged is pending)) and self.is_barrier(merged or earg): #later events are not merged into events before the barrier
+				self.pending_keys.clear()
+			if key != None:
+				self.pending_keys[key] = merged or earg
 		except Exception, e:
 			self.log_exception("Could not enque event.", Logtype.ERROR)
 		finally:
 			self.pending_events_lock.release()
 
-		self.write_state()
+		if not self.journal:
+			self.write_state()
 		self.log("Enqueued new event: " + sstr(earg), Logtype.DEBUG)
 
 	def close_queue(self):
-		self.accept_events = False
+		with self.pending_events_lock:
+			self.accept_events = False
+			self.pending_events_changed.notify_all()
 
 	def stop(self):
-		self._stop.set()
-
-class KillableThread(Thread):
-	'''A thread class that supports killing by throwing a ThreadKilledException'''
-
-	def kill(self):
-		res = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.ident), ctypes.py_object(ThreadKilledException))
-		if res != 1:
-			ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.ident), 0)
-			raise SystemError("Killing thread failed")
+		with self.pending_events_lock:
+			self._stop.set()
+			self.pending_events_changed.notify_all()
 
-class ThreadKilledException (Exception):
-	pass